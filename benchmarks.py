@@ -0,0 +1,385 @@
+"""Throughput benchmarks for the Mini-C compiler front end.
+
+Run with ``python benchmarks.py [statements]``; results go to stdout
+(redirect to bench_output.txt to keep them around).
+"""
+import re
+import sys
+import time
+import tracemalloc
+
+from compilation import MiniCLexer, Token, Parser, IterativeParser, BinaryOp
+from compilation import CodeGenVisitor, ASTArena, IncrementalParser, ParsingException
+from compilation import AsmLine, PeepholeOptimizer, ConstantFolder, PassManager
+from compilation import IRProgram, lower_to_ir, select_instructions, DeadCodeEliminator
+from compilation import RamAllocator, BankSelector, TypeChecker
+
+
+def generate_source(statements=2000):
+    """Build a large, deterministic Mini-C program for benchmarking."""
+    lines = ["int main() {", "    int counter;", "    int total;", "    char flag;"]
+    for i in range(statements):
+        if i % 4 == 0:
+            lines.append(f"    counter = counter + {i % 97}; // step {i}")
+        elif i % 4 == 1:
+            lines.append(f"    if (counter > {i % 50}) {{ total = total - (counter * 2); }}")
+        elif i % 4 == 2:
+            lines.append(f"    while (flag != 0) {{ flag = flag - 1; }} /* loop {i} */")
+        else:
+            lines.append(f"    total = (total + counter) / {i % 7 + 1};")
+    lines.append("}")
+    return "\n".join(lines)
+
+
+# Reference copy of the original lexer: per-instance regex compilation,
+# keywords as separate \b...\b alternatives and a per-character position loop.
+legacy_token_specification = [
+    (r"\s+",              None),
+    (r"//.*",             None),
+    (r"/\*[\s\S]*?\*/",   None),
+    (r"\bint\b",          'KW_INT'),
+    (r"\bfloat\b",        'KW_FLOAT'),
+    (r"\bbool\b",         'KW_BOOL'),
+    (r"\bchar\b",         'KW_CHAR'),
+    (r"\bif\b",           'KW_IF'),
+    (r"\belse\b",         'KW_ELSE'),
+    (r"\bwhile\b",        'KW_WHILE'),
+    (r"\bmain\b",         'KW_MAIN'),
+    (r"\d+",              'INT_LITERAL'),
+    (r"[A-Za-z_]\w*",     'IDENT'),
+    (r"\(",               'LPAREN'),
+    (r"\)",               'RPAREN'),
+    (r"\{",               'LBRACE'),
+    (r"\}",               'RBRACE'),
+    (r"\[",               'LBRACKET'),
+    (r"\]",               'RBRACKET'),
+    (r";",                'SEMICOLON'),
+    (r",",                'COMMA'),
+    (r"\|\|",             'OR'),
+    (r"&&",               'AND'),
+    (r"==",               'EQ'),
+    (r"!=",               'NEQ'),
+    (r"<=",               'LTE'),
+    (r">=",               'GTE'),
+    (r"<",                'LT'),
+    (r">",                'GT'),
+    (r"=",                'ASSIGN'),
+    (r"\+",               'PLUS'),
+    (r"-",                'MINUS'),
+    (r"\*",               'MULT'),
+    (r"/",                'DIV'),
+    (r"!",                'NOT'),
+]
+
+class LegacyMiniCLexer:
+    def __init__(self, code):
+        self.code = code
+        parts = []
+        for idx, (pattern, name) in enumerate(legacy_token_specification):
+            group = name or f"SKIP_{idx}"
+            parts.append(f"(?P<{group}>{pattern})")
+        self.big_regex = re.compile('|'.join(parts))
+
+    def tokenize(self):
+        tokens = []
+        line, col = 1, 1
+        for match in self.big_regex.finditer(self.code):
+            kind = match.lastgroup
+            text = match.group()
+            if kind and kind.startswith('SKIP'):
+                for ch in text:
+                    if ch == '\n': line += 1; col = 1
+                    else: col += 1
+                continue
+            tokens.append(Token(kind, text, line, col))
+            for ch in text:
+                if ch == '\n': line += 1; col = 1
+                else: col += 1
+        return tokens
+
+
+class LegacyExpressionParser(Parser):
+    """Parser with the original seven-level recursive-descent expression cascade."""
+    def parse_expression(self):
+        return self.parse_or()
+    def parse_or(self):
+        left = self.parse_and()
+        while self.peek_type() == 'OR':
+            op    = self.accept().value
+            right = self.parse_and()
+            left  = BinaryOp(op, left, right)
+        return left
+    def parse_and(self):
+        left = self.parse_equality()
+        while self.peek_type() == 'AND':
+            op    = self.accept().value
+            right = self.parse_equality()
+            left  = BinaryOp(op, left, right)
+        return left
+    def parse_equality(self):
+        left = self.parse_relational()
+        while self.peek_type() in ('EQ','NEQ'):
+            op    = self.accept().value
+            right = self.parse_relational()
+            left  = BinaryOp(op, left, right)
+        return left
+    def parse_relational(self):
+        left = self.parse_additive()
+        while self.peek_type() in ('LT','GT','LTE','GTE'):
+            op    = self.accept().value
+            right = self.parse_additive()
+            left  = BinaryOp(op, left, right)
+        return left
+    def parse_additive(self):
+        left = self.parse_multiplicative()
+        while self.peek_type() in ('PLUS','MINUS'):
+            op    = self.accept().value
+            right = self.parse_multiplicative()
+            left  = BinaryOp(op, left, right)
+        return left
+    def parse_multiplicative(self):
+        left = self.parse_unary()
+        while self.peek_type() in ('MULT','DIV'):
+            op    = self.accept().value
+            right = self.parse_unary()
+            left  = BinaryOp(op, left, right)
+        return left
+
+
+class RecursiveCodeGen(CodeGenVisitor):
+    """Drives the same walkXxx handlers by plain recursion, for comparison."""
+    def walk(self, node):
+        self.run(self.dispatch[type(node)][0](self, node))
+
+    def run(self, steps):
+        for item in steps or ():
+            if type(item) is str:
+                self.emit(item)
+            elif type(item) in self.dispatch:
+                self.walk(item)
+            else:
+                self.run(item())
+
+
+def generate_expression_source(statements=2000):
+    """Assignments whose right-hand sides exercise every precedence level."""
+    lines = ["int a;", "int b;", "int c;", "int d;"]
+    for i in range(statements):
+        lines.append(f"a = (b + {i % 9} * c - d / 2) < {i % 31} && !(a == b || c != {i % 5})"
+                     f" || -b + c * (d - {i % 3}) >= a;")
+    return "\n".join(lines)
+
+
+def best_time(fn, repeat=5):
+    """Best wall-clock time of ``fn()`` over ``repeat`` runs, plus its result."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(title, rows):
+    print(f"\n=== {title} ===")
+    for label, value in rows:
+        print(f"  {label:<40} {value}")
+
+
+def bench_lexer(source):
+    # Many small sources is the batch-compile case where per-instance
+    # regex construction used to dominate.
+    chunks = source.split("\n")
+    small = ["\n".join(chunks[i:i + 8]) for i in range(0, len(chunks), 8)]
+    rows = []
+    for label, lexer_cls in (("before (legacy lexer)", LegacyMiniCLexer),
+                             ("after (shared tables)", MiniCLexer)):
+        elapsed, tokens = best_time(lambda: lexer_cls(source).tokenize())
+        rows.append((f"{label}, one large file", f"{len(tokens) / elapsed:>12,.0f} tokens/sec"))
+        elapsed, count = best_time(lambda: sum(len(lexer_cls(s).tokenize()) for s in small))
+        rows.append((f"{label}, {len(small)} small files", f"{count / elapsed:>12,.0f} tokens/sec"))
+    report("Lexer throughput", rows)
+
+
+def bench_parser(source):
+    tokens = MiniCLexer(source).tokenize()
+    rows = []
+    for label, parser_cls in (("before (7-level cascade)", LegacyExpressionParser),
+                              ("after (precedence climbing)", Parser)):
+        elapsed, _ = best_time(lambda: parser_cls(tokens).parse())
+        rows.append((label, f"{len(tokens) / elapsed:>12,.0f} tokens/sec"))
+    report("Parser throughput, expression-heavy input", rows)
+
+
+def bench_explicit_stack(source):
+    tokens = MiniCLexer(source).tokenize()
+    program = Parser(tokens).parse()
+    rows = []
+    for label, parser_cls in (("Parser (recursive)", Parser),
+                              ("IterativeParser (explicit stack)", IterativeParser)):
+        elapsed, _ = best_time(lambda: parser_cls(tokens).parse())
+        rows.append((label, f"{len(tokens) / elapsed:>12,.0f} tokens/sec"))
+    for label, cg_cls in (("codegen, recursive walk", RecursiveCodeGen),
+                          ("codegen, explicit-stack walk", CodeGenVisitor)):
+        elapsed, _ = best_time(lambda: cg_cls().walk(program))
+        rows.append((label, f"{elapsed * 1000:>12.2f} ms"))
+    report("Recursive vs explicit-stack", rows)
+
+
+def allocated_bytes(fn):
+    """Bytes still allocated after ``fn()`` returns, with its result kept alive."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return after - before, result
+
+
+def bench_token_memory(source):
+    lexer = MiniCLexer(source)
+    lexer.line_starts()
+    list_bytes, tokens = allocated_bytes(lexer.tokenize)
+    buffer_bytes, buf = allocated_bytes(lexer.tokenize_compact)
+    count = len(tokens)
+    report("Token memory", [
+        ("tokens", f"{count:>12,}"),
+        ("list[Token] (slotted objects)", f"{list_bytes / count:>12.1f} bytes/token"),
+        ("TokenBuffer (arrays)", f"{buffer_bytes / count:>12.1f} bytes/token"),
+        ("TokenBuffer arrays, exact", f"{buf.nbytes() / count:>12.1f} bytes/token"),
+    ])
+
+
+def bench_ast_memory(source):
+    tokens = MiniCLexer(source).tokenize()
+    tree_bytes, program = allocated_bytes(lambda: IterativeParser(tokens).parse())
+    elapsed, (arena, _) = best_time(lambda: ASTArena.from_tree(program), repeat=3)
+    nodes = len(arena)
+    report("AST memory", [
+        ("nodes", f"{nodes:>12,}"),
+        ("object tree (slotted, incl. lists)", f"{tree_bytes / nodes:>12.1f} bytes/node"),
+        ("ASTArena arrays", f"{arena.nbytes() / nodes:>12.1f} bytes/node"),
+        ("ASTArena encode time", f"{elapsed * 1000:>12.2f} ms"),
+    ])
+
+
+def bench_incremental(source, edits=200):
+    # Keystroke-sized edits spread through the file: rewrite one literal each time.
+    inc = IncrementalParser(source)
+    sites = [m.start() for m in re.finditer(r"counter \+ \d", source)][:edits]
+
+    def full():
+        code = source
+        for pos in sites:
+            code = code[:pos + 10] + "7" + code[pos + 11:]
+            IterativeParser(MiniCLexer(code).tokenize_compact()).parse()
+
+    def incremental():
+        for pos in sites:
+            inc.edit(pos + 10, pos + 11, "7")
+
+    full_time, _ = best_time(full, repeat=3)
+    inc_time, _ = best_time(incremental, repeat=3)
+    report("Incremental re-parse, one-character edits", [
+        ("edits", f"{len(sites):>12,}"),
+        ("full re-lex + re-parse", f"{full_time / len(sites) * 1000:>12.3f} ms/edit"),
+        ("IncrementalParser.edit", f"{inc_time / len(sites) * 1000:>12.3f} ms/edit"),
+    ])
+
+
+def bench_recovery(source, errors=10):
+    # A file with several mistakes: fail-fast needs one run per error (fixing
+    # the first each time), recovery mode reports them all from one run.
+    lines = source.split("\n")
+    broken = [i for i in range(4, len(lines) - 1, (len(lines) - 5) // errors)][:errors]
+    for i in broken:
+        lines[i] = lines[i].replace(";", " +;", 1)
+    bad = "\n".join(lines)
+
+    def fail_fast():
+        text, runs = bad, 0
+        while True:
+            runs += 1
+            try:
+                IterativeParser(MiniCLexer(text).tokenize_compact()).parse()
+                return runs
+            except ParsingException:
+                text = text.replace(" +;", ";", 1)
+
+    def recovering():
+        parser = IterativeParser(MiniCLexer(bad).tokenize_compact(), recover=True)
+        parser.parse()
+        return len(parser.diagnostics)
+
+    ff_time, runs = best_time(fail_fast, repeat=3)
+    rec_time, found = best_time(recovering, repeat=3)
+    report(f"Reporting {len(broken)} syntax errors", [
+        (f"fail-fast, {runs} runs", f"{ff_time * 1000:>12.2f} ms"),
+        (f"recovery mode, {found} diagnostics", f"{rec_time * 1000:>12.2f} ms"),
+    ])
+
+
+def bench_peephole(source):
+    # Code size and straight-line cycle cost of the emitted assembly, with the
+    # optimiser's own run time; each rule's share comes from its stats.
+    visitor = CodeGenVisitor()
+    IterativeParser(MiniCLexer(source).tokenize_compact()).parse().accept(visitor)
+
+    def cost(lines):
+        parsed = [AsmLine.parse(line) for line in lines]
+        return sum(l.words for l in parsed), sum(l.cycles for l in parsed)
+
+    optimizer = PeepholeOptimizer()
+    optimized = optimizer.optimize(visitor.code)
+    elapsed, _ = best_time(lambda: PeepholeOptimizer().optimize(visitor.code))
+    rows = []
+    for label, lines in (("before", visitor.code), ("after peephole", optimized)):
+        words, cycles = cost(lines)
+        rows.append((label, f"{words:>12,} words {cycles:>10,} cycles"))
+    rows.append((f"optimiser time, {optimizer.sweeps} sweeps", f"{elapsed * 1000:>12.2f} ms"))
+    rows += [(f"  {line.split(':')[0]}", line.split(': ', 1)[1]) for line in optimizer.report()]
+    report("Peephole optimiser", rows)
+
+
+def bench_passes(source):
+    # Per-pass cost of the compile pipeline after parsing, best of several runs,
+    # against the direct AST-to-text code generator it replaced.
+    program = IterativeParser(MiniCLexer(source).tokenize_compact()).parse()
+    passes = PassManager([("fold", ConstantFolder().transform), ("lower", lower_to_ir),
+                          ("types", lambda ir: TypeChecker().run(ir)), ("cfg", IRProgram.link), ("dce", lambda ir: DeadCodeEliminator().run(ir)),
+                          ("alloc", lambda ir: RamAllocator().run(ir)),
+                          ("select", select_instructions),
+                          ("peephole", lambda lines: PeepholeOptimizer().optimize(lines)),
+                          ("banks", lambda lines: BankSelector().run(lines))])
+    best = {}
+    for _ in range(5):
+        passes.run(program)
+        for name, seconds in passes.timings:
+            best[name] = min(seconds, best.get(name, seconds))
+    direct, _ = best_time(lambda: program.accept(CodeGenVisitor()))
+    rows = [(name, f"{seconds * 1000:>12.2f} ms") for name, seconds in best.items()]
+    rows.append(("CodeGenVisitor, no IR", f"{direct * 1000:>12.2f} ms"))
+    report("Compile passes", rows)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    statements = int(argv[0]) if argv else 2000
+    source = generate_source(statements)
+    print(f"Benchmark source: {statements} statements, {len(source):,} characters")
+    bench_lexer(source)
+    bench_token_memory(source)
+    bench_parser(generate_expression_source(statements))
+    bench_explicit_stack(source)
+    bench_ast_memory(source)
+    bench_incremental(source)
+    bench_recovery(source)
+    bench_peephole(source)
+    bench_passes(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -78,10 +78,9 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVLW 0x05", assembly, "Expected MOVLW 0x05 for b = 5")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
         # Verify addition
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load a")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store a to temp")
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("ADDWF 0x7F, W", assembly, "Expected ADDWF 0x7F, W for addition")
+        self.assertIn("MOVF 0x20, W\nADDWF 0x21, W", assembly,
+                      "Expected a loaded into W and b added straight from its register")
+        self.assertNotIn("MOVWF 0x7F", assembly, "A leaf operand needs no temp")
         self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing c")
         print("Assertions Passed: All expected instructions for addition found")
     
@@ -106,10 +105,9 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVLW 0x07", assembly, "Expected MOVLW 0x07 for b = 7")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
         # Verify subtraction
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load a")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store a to temp")
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("SUBWF 0x7F, W", assembly, "Expected SUBWF 0x7F, W for subtraction")
+        self.assertIn("MOVF 0x21, W\nSUBWF 0x20, W", assembly,
+                      "Expected b loaded into W and subtracted from a in place")
+        self.assertNotIn("MOVWF 0x7F", assembly, "A leaf operand needs no temp")
         self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing result")
         print("Assertions Passed: All expected instructions for subtraction found")
     
@@ -133,13 +131,15 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVWF 0x20", assembly, "Expected MOVWF 0x20 for storing a")
         self.assertIn("MOVLW 0x04", assembly, "Expected MOVLW 0x04 for b = 4")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
-        # Verify multiplication (not implemented)
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load a")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store a to temp")
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("; MULT not implemented", assembly, "Expected MULT not implemented comment")
-        self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing result")
-        print("Assertions Passed: Expected instructions for multiplication found (not implemented)")
+        # Verify multiplication: a and b go to the helper's registers for the call
+        self.assertIn("MOVF 0x20, W\nMOVWF 0x7F\nMOVF 0x21, W\nMOVWF 0x7E\n"
+                      "CALL __mul8\nMOVWF 0x22", assembly,
+                      "Expected a and b passed to __mul8 and the product stored")
+        self.assertNotIn("not implemented", assembly, "Expected multiplication to be implemented")
+        self.assertEqual(assembly.count("__mul8:"), 1, "Expected one copy of the helper")
+        self.assertLess(assembly.index("__end:\nGOTO __end"), assembly.index("__mul8:"),
+                        "Expected the program to stop short of the helper")
+        print("Assertions Passed: Expected instructions for multiplication found")
     
     def test_division(self):
         """Test division operation"""
@@ -161,13 +161,13 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVWF 0x20", assembly, "Expected MOVWF 0x20 for storing a")
         self.assertIn("MOVLW 0x05", assembly, "Expected MOVLW 0x05 for b = 5")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
-        # Verify division (not implemented)
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load a")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store a to temp")
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("; DIV not implemented", assembly, "Expected DIV not implemented comment")
-        self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing result")
-        print("Assertions Passed: Expected instructions for division found (not implemented)")
+        # Verify division: a and b go to the helper's registers for the call
+        self.assertIn("MOVF 0x20, W\nMOVWF 0x7F\nMOVF 0x21, W\nMOVWF 0x7E\n"
+                      "CALL __div8\nMOVWF 0x22", assembly,
+                      "Expected a and b passed to __div8 and the quotient stored")
+        self.assertNotIn("not implemented", assembly, "Expected division to be implemented")
+        self.assertEqual(assembly.count("__div8:"), 1, "Expected one copy of the helper")
+        print("Assertions Passed: Expected instructions for division found")
     
     def test_comparison_operations(self):
         """Test comparison operations"""
@@ -194,17 +194,15 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVWF 0x20", assembly, "Expected MOVWF 0x20 for storing a")
         self.assertIn("MOVLW 0x05", assembly, "Expected MOVLW 0x05 for b = 5")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
-        # Verify comparison (not implemented)
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load a")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store a to temp")
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("; op > not implemented", assembly, "Expected op > not implemented comment")
-        self.assertIn("CPFSEQ W", assembly, "Expected CPFSEQ W for comparison")
-        self.assertIn("GOTO else0", assembly, "Expected GOTO else0 for branching")
+        # Verify comparison: a > b is b - a borrowing, so C clear means true
+        self.assertIn("MOVF 0x20, W\nSUBWF 0x21, W\n"
+                      "BTFSC STATUS, C\nGOTO else0", assembly,
+                      "Expected b - a with a carry test jumping to else0")
+        self.assertNotIn("CPFSEQ", assembly, "CPFSEQ is not a PIC16 mid-range instruction")
         self.assertIn("MOVLW 0x01", assembly, "Expected MOVLW 0x01 for result = 1")
         self.assertIn("MOVLW 0x00", assembly, "Expected MOVLW 0x00 for result = 0")
         self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing result")
-        print("Assertions Passed: Expected instructions for comparison found (not implemented)")
+        print("Assertions Passed: Expected instructions for comparison found")
     
     def test_logical_operations(self):
         """Test logical operations (AND, OR)"""
@@ -238,16 +236,19 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVWF 0x20", assembly, "Expected MOVWF 0x20 for storing a")
         self.assertIn("MOVLW 0x00", assembly, "Expected MOVLW 0x00 for b = 0")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
-        # Verify logical operations (not implemented)
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load a")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store a to temp")
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("; op && not implemented", assembly, "Expected op && not implemented comment")
-        self.assertIn("; op || not implemented", assembly, "Expected op || not implemented comment")
-        self.assertIn("CPFSEQ W", assembly, "Expected CPFSEQ W for comparison")
+        # Verify short-circuit jump chains: && leaves on the first false
+        # operand, || skips the rest on the first true one
+        self.assertIn("MOVF 0x20, F\nBTFSC STATUS, Z\nGOTO else0\n"
+                      "MOVF 0x21, F\nBTFSC STATUS, Z\nGOTO else0", assembly,
+                      "Expected && as two zero tests jumping to else0")
+        self.assertIn("MOVF 0x20, F\nBTFSS STATUS, Z\nGOTO skip4\n"
+                      "MOVF 0x21, F\nBTFSC STATUS, Z\nGOTO else2\nskip4:", assembly,
+                      "Expected || to skip the second test when a is true")
+        self.assertNotIn("CPFSEQ", assembly, "CPFSEQ is not a PIC16 mid-range instruction")
+        self.assertNotIn("not implemented", assembly, "Expected && and || to be implemented")
         self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing c")
         self.assertIn("MOVWF 0x23", assembly, "Expected MOVWF 0x23 for storing d")
-        print("Assertions Passed: Expected instructions for logical operations found (not implemented)")
+        print("Assertions Passed: Expected instructions for logical operations found")
     
     def test_if_statement(self):
         """Test if statement without else"""
@@ -268,17 +269,14 @@ class TestCompilerIntegration(unittest.TestCase):
         # Verify variable assignment
         self.assertIn("MOVLW 0x0A", assembly, "Expected MOVLW 0x0A for x = 10")
         self.assertIn("MOVWF 0x20", assembly, "Expected MOVWF 0x20 for storing x")
-        # Verify comparison (not implemented)
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load x")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store x to temp")
-        self.assertIn("MOVLW 0x05", assembly, "Expected MOVLW 0x05 for comparison")
-        self.assertIn("; op > not implemented", assembly, "Expected op > not implemented comment")
-        self.assertIn("CPFSEQ W", assembly, "Expected CPFSEQ W for comparison")
-        self.assertIn("GOTO else0", assembly, "Expected GOTO else0 for branching")
+        # Verify comparison against a literal: 5 - x sets C when x <= 5
+        self.assertIn("MOVF 0x20, W\nSUBLW 0x05\nBTFSC STATUS, C\nGOTO else0", assembly,
+                      "Expected SUBLW 0x05 and a carry test jumping to else0")
+        self.assertNotIn("CPFSEQ", assembly, "CPFSEQ is not a PIC16 mid-range instruction")
         self.assertIn("MOVLW 0x01", assembly, "Expected MOVLW 0x01 for y = 1")
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing y")
         self.assertIn("GOTO ifend1", assembly, "Expected GOTO ifend1 to skip else")
-        print("Assertions Passed: Expected instructions for if statement found (not implemented)")
+        print("Assertions Passed: Expected instructions for if statement found")
     
     def test_if_else_statement(self):
         """Test if-else statement"""
@@ -303,10 +301,9 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVWF 0x20", assembly, "Expected MOVWF 0x20 for storing x")
         # Verify comparison and branching
         self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load x")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store x to temp")
-        self.assertIn("MOVLW 0x05", assembly, "Expected MOVLW 0x05 for comparison")
-        self.assertIn("; op > not implemented", assembly, "Expected op > not implemented comment")
-        self.assertIn("CPFSEQ W", assembly, "Expected CPFSEQ W for comparison")
+        self.assertIn("SUBLW 0x05", assembly, "Expected SUBLW 0x05 for comparison")
+        self.assertIn("BTFSC STATUS, C", assembly, "Expected a carry test for x > 5")
+        self.assertNotIn("CPFSEQ", assembly, "CPFSEQ is not a PIC16 mid-range instruction")
         self.assertIn("GOTO else0", assembly, "Expected GOTO else0 for else branch")
         self.assertIn("MOVLW 0x01", assembly, "Expected MOVLW 0x01 for y = 1")
         self.assertIn("MOVLW 0x00", assembly, "Expected MOVLW 0x00 for y = 0")
@@ -314,7 +311,7 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("GOTO ifend1", assembly, "Expected GOTO ifend1 to skip else")
         self.assertIn("else0:", assembly, "Expected else0 label")
         self.assertIn("ifend1:", assembly, "Expected ifend1 label")
-        print("Assertions Passed: Expected instructions for if-else statement found (not implemented)")
+        print("Assertions Passed: Expected instructions for if-else statement found")
     
     def test_while_loop(self):
         """Test while loop"""
@@ -341,18 +338,17 @@ class TestCompilerIntegration(unittest.TestCase):
         # Verify while loop structure
         self.assertIn("while0:", assembly, "Expected while0 label")
         self.assertIn("wend1:", assembly, "Expected wend1 label")
-        # Verify comparison (not implemented)
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load i")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store i to temp")
-        self.assertIn("MOVLW 0x05", assembly, "Expected MOVLW 0x05 for comparison")
-        self.assertIn("; op < not implemented", assembly, "Expected op < not implemented comment")
-        self.assertIn("CPFSEQ W", assembly, "Expected CPFSEQ W for comparison")
+        # Verify comparison: i < 5 is i <= 4, i.e. 4 - i without borrow
+        self.assertIn("while0:\nMOVF 0x20, W\nSUBLW 0x04\nBTFSS STATUS, C\nGOTO wend1", assembly,
+                      "Expected SUBLW 0x04 and a carry test leaving the loop")
+        self.assertNotIn("CPFSEQ", assembly, "CPFSEQ is not a PIC16 mid-range instruction")
         # Verify loop body
         self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load sum")
-        self.assertIn("ADDWF 0x7F, W", assembly, "Expected ADDWF 0x7F, W for sum += i")
-        self.assertIn("MOVLW 0x01", assembly, "Expected MOVLW 0x01 for i += 1")
+        self.assertIn("MOVF 0x21, W\nADDWF 0x20, W\nMOVWF 0x21", assembly,
+                      "Expected ADDWF 0x20, W for sum += i")
+        self.assertIn("ADDLW 0x01", assembly, "Expected ADDLW 0x01 for i += 1")
         self.assertIn("GOTO while0", assembly, "Expected GOTO while0 to loop back")
-        print("Assertions Passed: Expected instructions for while loop found (not implemented)")
+        print("Assertions Passed: Expected instructions for while loop found")
     
     def test_nested_if_statements(self):
         """Test nested if statements"""
@@ -418,22 +414,24 @@ class TestCompilerIntegration(unittest.TestCase):
         self.assertIn("MOVWF 0x21", assembly, "Expected MOVWF 0x21 for storing b")
         self.assertIn("MOVLW 0x02", assembly, "Expected MOVLW 0x02 for c = 2")
         self.assertIn("MOVWF 0x22", assembly, "Expected MOVWF 0x22 for storing c")
-        # Verify expression (multiplication not implemented)
-        self.assertIn("MOVF 0x21, W", assembly, "Expected MOVF 0x21, W to load b")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store b to temp")
-        self.assertIn("MOVF 0x22, W", assembly, "Expected MOVF 0x22, W to load c")
-        self.assertIn("; MULT not implemented", assembly, "Expected MULT not implemented comment")
-        self.assertIn("MOVWF 0x23", assembly, "Expected MOVWF 0x23 for storing result")
-        print("Assertions Passed: Expected instructions for complex expression found (multiplication not implemented)")
+        # Verify expression: b * c first, then a added to the product
+        self.assertIn("MOVF 0x21, W\nMOVWF 0x7F\nMOVF 0x22, W\nMOVWF 0x7E\n"
+                      "CALL __mul8\nADDWF 0x20, W\nMOVWF 0x23", assembly,
+                      "Expected b * c by __mul8, then a added and the sum stored")
+        self.assertNotIn("not implemented", assembly, "Expected multiplication to be implemented")
+        print("Assertions Passed: Expected instructions for complex expression found")
     
     def test_array_operations(self):
         """Test array declarations and operations"""
         source_code = """
         int arr[5];
+        int i;
         
         arr[0] = 10;
         arr[1] = 20;
         arr[2] = arr[0] + arr[1];
+        i = 3;
+        arr[i] = arr[i + 1];
         """
         print("Source Code:\n", source_code.strip())
         assembly = self.compile_code(source_code)
@@ -442,9 +440,18 @@ class TestCompilerIntegration(unittest.TestCase):
         # Verify assignments
         self.assertIn("MOVLW 0x0A", assembly, "Expected MOVLW 0x0A for arr[0] = 10")
         self.assertIn("MOVLW 0x14", assembly, "Expected MOVLW 0x14 for arr[1] = 20")
-        self.assertIn("; array indexing not implemented", assembly, "Expected array indexing not implemented comment")
-        self.assertGreaterEqual(assembly.count("MOVWF"), 3, "Expected at least 3 MOVWF instructions")
-        print("Assertions Passed: Expected instructions for array operations found (indexing not implemented)")
+        # Constant indices address the elements directly: arr takes 0x20-0x24
+        self.assertIn("MOVLW 0x0A\nMOVWF 0x20\nMOVLW 0x14\nMOVWF 0x21", assembly,
+                      "Expected arr[0] and arr[1] stored in place")
+        self.assertIn("MOVF 0x20, W\nMOVWF 0x7F\nMOVF 0x21, W\nADDWF 0x7F, W\nMOVWF 0x22",
+                      assembly, "Expected arr[0] + arr[1] stored to arr[2]")
+        # A variable index goes through FSR, the + 1 folded into the base;
+        # the value waits in a temp while FSR is pointed at arr[i]
+        self.assertIn("MOVF 0x25, W\nADDLW 0x21\nMOVWF FSR\nMOVF INDF, W\nMOVWF 0x7F\n"
+                      "MOVF 0x25, W\nADDLW 0x20\nMOVWF FSR\nMOVF 0x7F, W\nMOVWF INDF",
+                      assembly, "Expected arr[i + 1] read and arr[i] written through INDF")
+        self.assertNotIn("not implemented", assembly, "Expected array indexing to be implemented")
+        print("Assertions Passed: Expected instructions for array operations found")
     
     def test_main_function(self):
         """Test compilation of code in a main function"""
@@ -495,13 +502,13 @@ class TestCompilerIntegration(unittest.TestCase):
         # Verify while loop structure
         self.assertIn("while0:", assembly, "Expected while0 label")
         self.assertIn("wend1:", assembly, "Expected wend1 label")
-        self.assertIn("MOVF 0x20, W", assembly, "Expected MOVF 0x20, W to load i")
-        self.assertIn("MOVWF 0x7F", assembly, "Expected MOVWF 0x7F to store i to temp")
-        self.assertIn("MOVF 0x22, W", assembly, "Expected MOVF 0x22, W to load n")
-        self.assertIn("; op <= not implemented", assembly, "Expected op <= not implemented comment")
-        self.assertIn("CPFSEQ W", assembly, "Expected CPFSEQ W for comparison")
+        # i <= n is n - i without borrow: i goes to W and n is subtracted from in place
+        self.assertIn("MOVF 0x20, W\nSUBWF 0x22, W\n"
+                      "BTFSS STATUS, C\nGOTO wend1", assembly,
+                      "Expected n - i with a carry test leaving the loop")
+        self.assertNotIn("CPFSEQ", assembly, "CPFSEQ is not a PIC16 mid-range instruction")
         self.assertIn("GOTO while0", assembly, "Expected GOTO while0 to loop back")
-        print("Assertions Passed: All expected instructions for full program found (comparison not implemented)")
+        print("Assertions Passed: All expected instructions for full program found")
 
 if __name__ == "__main__":
     # Run tests with verbose output
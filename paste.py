@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from io import StringIO
 import sys
@@ -7,9 +9,17 @@ import sys
 # For our test, we'll assume they're imported directly
 
 # Since we're working with the code from the notebook, let's make sure our tests will work with those classes
-from compilation import MiniCLexer, Token, Parser, CodeGenVisitor
+from compilation import MiniCLexer, Token, TokenBuffer, Parser, IterativeParser, CodeGenVisitor
 from compilation import Program, Block, Declaration, AssignmentStatement, IfStatement, WhileStatement
 from compilation import BinaryOp, UnaryOp, Literal, Identifier, Parenthesized, ParsingException
+from compilation import compile_source, compile_file, ASTArena
+from compilation import ASTWalker, ASTTransformer, FusedWalker, iter_children
+from compilation import IncrementalParser, ConstantFolder, AsmLine, PeepholeOptimizer, annotate_loops
+from compilation import lower_to_ir, select_instructions, IRJump, IRBranch, PassManager
+from compilation import DeadCodeEliminator, RamAllocator, AllocationException, LoopOptimizer
+from compilation import BankSelector, register_bank, TypeChecker, TypeCheckException
+from compilation import constant_sequence, sequence_cost, software_multiply_cycles
+from compilation import software_divide_cycles, unrolled_multiply, unrolled_divide
 
 class TestMiniCLexer(unittest.TestCase):
     """Test cases for the lexical analyzer"""
@@ -51,6 +61,16 @@ class TestMiniCLexer(unittest.TestCase):
         for i, expected_type in enumerate(expected_types):
             self.assertEqual(tokens[i].type, expected_type)
     
+    def test_keyword_prefixes_are_identifiers(self):
+        """Test that identifiers starting with a keyword stay identifiers"""
+        tokens = MiniCLexer("integer mainly if_ while2 else").tokenize()
+        self.assertEqual([t.type for t in tokens],
+                         ["IDENT", "IDENT", "IDENT", "IDENT", "KW_ELSE"])
+
+    def test_lexers_share_compiled_tables(self):
+        """Test that lexer instances reuse one compiled regex"""
+        self.assertIs(MiniCLexer("int x;").big_regex, MiniCLexer("x = 1;").big_regex)
+
     def test_identifiers(self):
         """Test recognition of identifiers"""
         code = "x y1 _z count2 MAX_SIZE"
@@ -133,6 +153,56 @@ class TestMiniCLexer(unittest.TestCase):
         self.assertEqual(tokens[10].value, "10")
         self.assertEqual(tokens[12].type, "KW_IF")
 
+    def test_line_and_column_tracking(self):
+        """Test that tokens report the line/column where they start"""
+        code = "int x;\n/* two\n   lines */  x = 1;\n\n  y"
+        tokens = MiniCLexer(code).tokenize()
+        positions = [(t.value, t.line, t.col) for t in tokens]
+        self.assertEqual(positions, [
+            ("int", 1, 1), ("x", 1, 5), (";", 1, 6),
+            ("x", 3, 14), ("=", 3, 16), ("1", 3, 18), (";", 3, 19),
+            ("y", 5, 3),
+        ])
+
+    def test_iter_tokens_is_lazy(self):
+        """Test that iter_tokens yields on demand and matches tokenize"""
+        code = "int a; a = 1;\nwhile (a < 3) { a = a + 1; }"
+        lexer = MiniCLexer(code)
+        stream = lexer.iter_tokens()
+        first = next(stream)
+        self.assertEqual((first.type, first.line, first.col), ("KW_INT", 1, 1))
+        rest = [first] + list(stream)
+        expected = MiniCLexer(code).tokenize()
+        self.assertEqual([(t.type, t.value, t.line, t.col) for t in rest],
+                         [(t.type, t.value, t.line, t.col) for t in expected])
+        self.assertEqual(lexer.position(code.index("while")), (2, 1))
+
+
+    def test_compact_buffer_matches_tokens(self):
+        """Test that the array-backed buffer yields the same tokens lazily"""
+        code = "int main() {\n  int x;\n  x = x + 10; // tail\n}"
+        tokens = MiniCLexer(code).tokenize()
+        buf = MiniCLexer(code).tokenize_compact()
+        self.assertIsInstance(buf, TokenBuffer)
+        self.assertEqual(len(buf), len(tokens))
+        self.assertEqual(buf.types.typecode, "B")
+        self.assertEqual(buf.starts.typecode, "I")
+        self.assertEqual([(t.type, t.value, t.line, t.col) for t in buf],
+                         [(t.type, t.value, t.line, t.col) for t in tokens])
+        self.assertEqual(buf.nbytes(), 9 * len(buf))
+
+    def test_token_has_no_instance_dict(self):
+        """Test that Token uses __slots__ for the object-based path"""
+        self.assertFalse(hasattr(Token("IDENT", "x", 1, 1), "__dict__"))
+
+    def test_bytes_source(self):
+        """Test that a bytes source lexes like the equivalent str"""
+        code = "int main() {\n  x = 10; /* c */ y = x;\n}"
+        expected = MiniCLexer(code).tokenize()
+        for tokens in (MiniCLexer(code.encode()).tokenize(),
+                       list(MiniCLexer(code.encode()).tokenize_compact())):
+            self.assertEqual([(t.type, t.value, t.line, t.col) for t in tokens],
+                             [(t.type, t.value, t.line, t.col) for t in expected])
 
 class TestParser(unittest.TestCase):
     """Test cases for the parser"""
@@ -325,6 +395,127 @@ class TestParser(unittest.TestCase):
         # Check right side of multiplication
         self.assertEqual(assign_stmt.rhs.right.value, 4)
     
+    def test_parse_from_token_buffer(self):
+        """Test that the parser consumes a TokenBuffer directly"""
+        code = "int x; x = (2 + 3) * 4; if (x > 5) { x = 0; }"
+        program = Parser(MiniCLexer(code).tokenize_compact()).parse()
+        expected = Parser(MiniCLexer(code).tokenize()).parse()
+        self.assertEqual(repr(program), repr(expected))
+
+    def test_token_buffer_error_position(self):
+        """Test that syntax errors from a TokenBuffer still report line/col"""
+        parser = Parser(MiniCLexer("int x;\nx = ;").tokenize_compact())
+        with self.assertRaises(ParsingException) as ctx:
+            parser.parse()
+        self.assertIn("line 2, col 5", str(ctx.exception))
+
+    def test_parse_operator_precedence(self):
+        """Test binding power and left associativity of binary operators"""
+        code = "x = a || b && c == d < e + f * g - h / k;"
+        rhs = Parser(MiniCLexer(code).tokenize()).parse().statements[0].rhs
+        self.assertEqual(repr(rhs), repr(
+            BinaryOp("||", Identifier("a"),
+                BinaryOp("&&", Identifier("b"),
+                    BinaryOp("==", Identifier("c"),
+                        BinaryOp("<", Identifier("d"),
+                            BinaryOp("-",
+                                BinaryOp("+", Identifier("e"),
+                                         BinaryOp("*", Identifier("f"), Identifier("g"))),
+                                BinaryOp("/", Identifier("h"), Identifier("k")))))))))
+
+    def test_parse_left_associative_chain(self):
+        """Test that equal-precedence operators group to the left"""
+        code = "x = 1 - 2 - -3 != !4 != 5;"
+        rhs = Parser(MiniCLexer(code).tokenize()).parse().statements[0].rhs
+        self.assertEqual(repr(rhs), repr(
+            BinaryOp("!=",
+                BinaryOp("!=",
+                    BinaryOp("-", BinaryOp("-", Literal(1), Literal(2)),
+                             UnaryOp("-", Literal(3))),
+                    UnaryOp("!", Literal(4))),
+                Literal(5))))
+
+    def test_iterative_parser_matches_recursive(self):
+        """Test that the explicit-stack parser builds the same tree"""
+        code = """
+        int main() {
+            int a;
+            a = -(1 + 2) * !a[3 - a] / 4;
+            if (a < 1 || a >= 2) { { a = 1; } } else { while (a) { int q; q = a; } }
+            if (a) { a = 2; }
+        }
+        """
+        tokens = MiniCLexer(code).tokenize()
+        self.assertEqual(repr(IterativeParser(tokens).parse()), repr(Parser(tokens).parse()))
+
+    def test_iterative_parser_deep_nesting(self):
+        """Test that deep nesting parses without RecursionError"""
+        depth = 5000
+        code = ("while (a) { " * depth + "a = " + "(" * depth + "1" + ")" * depth + ";"
+                + " }" * depth)
+        program = IterativeParser(MiniCLexer(code).tokenize()).parse()
+        node = program.statements[0]
+        for _ in range(depth - 1):
+            node = node.body.statements[0]
+        rhs = node.body.statements[0].rhs
+        for _ in range(depth):
+            self.assertIsInstance(rhs, Parenthesized)
+            rhs = rhs.expr
+        self.assertEqual(rhs.value, 1)
+
+    def test_iterative_parser_errors_match(self):
+        """Test that the explicit-stack parser reports the same errors"""
+        for code in ("x = (1 + 2;", "if (x) { x = 1;", "while x { }", "x = a[1;", "x = * 2;"):
+            messages = []
+            for parser_cls in (Parser, IterativeParser):
+                with self.assertRaises(ParsingException) as ctx:
+                    parser_cls(MiniCLexer(code).tokenize()).parse()
+                messages.append(str(ctx.exception))
+            self.assertEqual(messages[0], messages[1], code)
+
+    def test_recovery_collects_all_errors(self):
+        """Test that recovery mode reports every error with line/col"""
+        code = "int x;\nx = ;\nx = 1;\nif (x + ) { x = 2; }\nx = 3 4;\nx = 5;"
+        for parser_cls in (Parser, IterativeParser):
+            parser = parser_cls(MiniCLexer(code).tokenize_compact(), recover=True)
+            program = parser.parse()
+            self.assertEqual([(d.line, d.col) for d in parser.diagnostics],
+                             [(2, 5), (4, 9), (5, 7)])
+            self.assertIn("Unexpected primary SEMICOLON", str(parser.diagnostics[0]))
+            self.assertIn("Expected SEMICOLON, got INT_LITERAL", str(parser.diagnostics[2]))
+            # The partial AST keeps every statement that parsed
+            self.assertEqual([s.rhs.value for s in program.statements], [1, 5])
+
+    def test_recovery_synchronises_at_rbrace(self):
+        """Test that an error inside a block resumes at its closing brace"""
+        code = "int main() { int a; while (a) { a = a +; a = 2 } a = 3; }"
+        for parser_cls in (Parser, IterativeParser):
+            parser = parser_cls(MiniCLexer(code).tokenize(), recover=True)
+            program = parser.parse()
+            self.assertEqual(len(parser.diagnostics), 2)
+            loop, tail = program.statements
+            self.assertIsInstance(loop, WhileStatement)
+            self.assertEqual(loop.body.statements, [])
+            self.assertEqual(tail.rhs.value, 3)
+
+    def test_recovery_missing_closing_braces(self):
+        """Test that unclosed blocks at end of input are kept and reported"""
+        code = "int main() { int a; if (a) { a = 1;"
+        parser = IterativeParser(MiniCLexer(code).tokenize(), recover=True)
+        program = parser.parse()
+        self.assertEqual([str(d) for d in parser.diagnostics],
+                         ["Syntax error at end of input: Unexpected end, wanted RBRACE"] * 2)
+        self.assertEqual((parser.diagnostics[0].line, parser.diagnostics[0].col), (1, 36))
+        self.assertEqual(program.statements[0].then_block.statements[0].rhs.value, 1)
+
+    def test_recovery_on_valid_input(self):
+        """Test that recovery mode changes nothing for a valid program"""
+        code = "int main() { int a; a = (1 + 2) * 3; if (a) { a = 1; } else { a = 2; } }"
+        tokens = MiniCLexer(code).tokenize()
+        parser = IterativeParser(tokens, recover=True)
+        self.assertEqual(repr(parser.parse()), repr(Parser(tokens).parse()))
+        self.assertEqual(parser.diagnostics, [])
+
     def test_parse_main_function(self):
         """Test parsing a program with main function"""
         code = """
@@ -383,7 +574,7 @@ class TestCodeGenVisitor(unittest.TestCase):
         visitor = CodeGenVisitor()
         program.accept(visitor)
         code = visitor.get_code()
-        expected_code = "MOVLW 0x05\nMOVWF 0x7F\nMOVLW 0x03\nADDWF 0x7F, W\nMOVWF 0x20"
+        expected_code = "MOVLW 0x05\nADDLW 0x03\nMOVWF 0x20"
         self.assertEqual(code, expected_code)
     
     def test_if_statement(self):
@@ -428,6 +619,1390 @@ class TestCodeGenVisitor(unittest.TestCase):
         self.assertIn("GOTO while0", code)
         self.assertIn("wend1:", code)
 
+    def generate(self, code):
+        visitor = CodeGenVisitor()
+        Parser(MiniCLexer(code).tokenize()).parse().accept(visitor)
+        return visitor.get_code()
+
+    def test_comparison_branches(self):
+        """Test the flag test and skip used for each comparison operator"""
+        head = "int x; int y; if ("
+        cases = {
+            "x == 3": "MOVF 0x20, W\nXORLW 0x03\nBTFSS STATUS, Z\nGOTO else0",
+            "x != y": "MOVF 0x20, W\nXORWF 0x21, W\nBTFSC STATUS, Z\nGOTO else0",
+            "x <= 3": "MOVF 0x20, W\nSUBLW 0x03\nBTFSS STATUS, C\nGOTO else0",
+            "x > 3": "MOVF 0x20, W\nSUBLW 0x03\nBTFSC STATUS, C\nGOTO else0",
+            "x < 3": "MOVF 0x20, W\nSUBLW 0x02\nBTFSS STATUS, C\nGOTO else0",
+            "x >= 3": "MOVF 0x20, W\nSUBLW 0x02\nBTFSC STATUS, C\nGOTO else0",
+            "3 > x": "MOVF 0x20, W\nSUBLW 0x02\nBTFSS STATUS, C\nGOTO else0",
+            "x >= y": "MOVF 0x21, W\nSUBWF 0x20, W\nBTFSS STATUS, C\nGOTO else0",
+            "x < y": "MOVF 0x21, W\nSUBWF 0x20, W\nBTFSC STATUS, C\nGOTO else0",
+            "!(x <= y)": "MOVF 0x20, W\nSUBWF 0x21, W\nBTFSC STATUS, C\nGOTO else0",
+            "x": "MOVF 0x20, F\nBTFSC STATUS, Z\nGOTO else0",
+            "x + 1": "MOVF 0x20, W\nADDLW 0x01\nIORLW 0x00\nBTFSC STATUS, Z\nGOTO else0",
+        }
+        for cond, expected in cases.items():
+            code = self.generate(f"{head}{cond}) {{ y = 1; }}")
+            self.assertTrue(code.startswith(expected + "\nMOVLW 0x01\nMOVWF 0x21"), (cond, code))
+
+    def test_constant_conditions(self):
+        """Test that known outcomes need no flag test"""
+        self.assertEqual(self.generate("int x; while (1) { x = 1; }"),
+                         "while0:\nMOVLW 0x01\nMOVWF 0x20\nGOTO while0\nwend1:")
+        self.assertTrue(self.generate("int x; if (x < 0) { x = 1; }").startswith("GOTO else0\n"))
+        self.assertTrue(self.generate("int x; if (x >= 0) { x = 1; }").startswith("MOVLW 0x01"))
+
+    def test_short_circuit_chains(self):
+        """Test that && and || become jump chains with no boolean in W"""
+        code = self.generate("int a; int b; int c; if (a && (b || !c)) { a = 1; }")
+        self.assertEqual(code.split("\nMOVLW 0x01")[0], "\n".join([
+            "MOVF 0x20, F", "BTFSC STATUS, Z", "GOTO else0",
+            "MOVF 0x21, F", "BTFSS STATUS, Z", "GOTO skip2",
+            "MOVF 0x22, F", "BTFSS STATUS, Z", "GOTO else0",
+            "skip2:"]))
+        self.assertNotIn("not implemented", code)
+
+    def test_condition_values(self):
+        """Test comparisons and logical operators assigned as 0/1 values"""
+        self.assertEqual(self.generate("int x; int y; y = x == 4;"),
+                         "MOVF 0x20, W\nXORLW 0x04\nMOVLW 0x00\nBTFSC STATUS, Z\nMOVLW 0x01\n"
+                         "MOVWF 0x21")
+        self.assertEqual(self.generate("int x; int y; y = !x;"),
+                         "MOVF 0x20, F\nMOVLW 0x00\nBTFSC STATUS, Z\nMOVLW 0x01\nMOVWF 0x21")
+        self.assertEqual(self.generate("int x; int y; y = x || y;"),
+                         "MOVF 0x20, F\nBTFSS STATUS, Z\nGOTO skip2\n"
+                         "MOVF 0x21, F\nBTFSC STATUS, Z\nGOTO false0\nskip2:\n"
+                         "MOVLW 0x01\nGOTO bend1\nfalse0:\nMOVLW 0x00\nbend1:\nMOVWF 0x21")
+
+    def test_long_condition_chain(self):
+        """Test a && chain longer than the recursion limit"""
+        depth = 5000
+        cond = Identifier("x")
+        for _ in range(depth):
+            cond = BinaryOp("&&", cond, Identifier("x"))
+        visitor = CodeGenVisitor()
+        Program([Declaration("int", "x")], [IfStatement(cond, Block([], []))]).accept(visitor)
+        self.assertEqual(visitor.code.count("GOTO else0"), depth + 1)
+
+    def visit(self, code):
+        visitor = CodeGenVisitor()
+        Parser(MiniCLexer(code).tokenize()).parse().accept(visitor)
+        return visitor
+
+    def test_leaf_operands(self):
+        """Test that variables and literals are used in place, without a temp"""
+        visitor = self.visit("int a; int b; a = a + (b - 3); b = 7 - (a + b);")
+        self.assertEqual(visitor.get_code(),
+                         "MOVLW 0x03\nSUBWF 0x21, W\nADDWF 0x20, W\nMOVWF 0x20\n"
+                         "MOVF 0x20, W\nADDWF 0x21, W\nSUBLW 0x07\nMOVWF 0x21")
+        self.assertEqual(visitor.temps, [])
+
+    def test_spill_order(self):
+        """Test that the operand needing more temps is evaluated first"""
+        head = "int a; int b; int c; int d; int x; "
+        self.assertEqual(self.visit(head + "x = (a + b) - (c + d);").get_code(),
+                         "MOVF 0x20, W\nADDWF 0x21, W\nMOVWF 0x7F\n"
+                         "MOVF 0x22, W\nADDWF 0x23, W\nSUBWF 0x7F, W\nMOVWF 0x24")
+        # The heavier right side goes first, so the difference is negated
+        visitor = self.visit(head + "x = (a + b) - ((c + d) + (a - b));")
+        self.assertEqual(visitor.get_code(),
+                         "MOVF 0x22, W\nADDWF 0x23, W\nMOVWF 0x7F\n"
+                         "MOVF 0x21, W\nSUBWF 0x20, W\nADDWF 0x7F, W\nMOVWF 0x7F\n"
+                         "MOVF 0x20, W\nADDWF 0x21, W\nSUBWF 0x7F, W\nSUBLW 0x00\nMOVWF 0x24")
+        self.assertEqual(visitor.temps, ["0x7F"])
+
+    def test_temp_reuse(self):
+        """Test that temps are released and reused across statements"""
+        head = "int a; int b; int c; int d; int x; "
+        visitor = self.visit(head + "x = (a + b) - (c + d); x = (a - b) + (c - d);")
+        self.assertEqual(visitor.temps, ["0x7F"])
+        self.assertEqual(visitor.free_temps, ["0x7F"])
+        visitor = self.visit(head + "x = ((a + b) - (c + d)) + ((a - b) + (c - d));")
+        self.assertEqual(visitor.temps, ["0x7F", "0x7E"])
+        self.assertIn("ADDWF 0x7E, W\nADDWF 0x7F, W\nMOVWF 0x24", visitor.get_code())
+
+    def test_nested_operands_are_not_clobbered(self):
+        """Test that a temp is never overwritten while it is still live"""
+        visitor = self.visit("int a; int b; int c; int d; "
+                             "if ((a + b) == (c + d) && (a - b) < (c - d)) { a = 1; }")
+        live = set()
+        for line in visitor.code:
+            op, _, operand = line.partition(" ")
+            addr = operand.split(",")[0]
+            if addr in visitor.temps:
+                if op == "MOVWF":
+                    self.assertNotIn(addr, live, line)
+                    live.add(addr)
+                else:
+                    live.discard(addr)
+        self.assertEqual(live, set())
+
+    def test_multiplication(self):
+        """Test a constant factor is a shift-and-add sequence, and other
+        products call __mul8 with both operands evaluated first"""
+        visitor = self.visit("int a; int b; a = 3 * a; b = (a + 1) * 4;")
+        self.assertEqual(visitor.get_code(),
+                         "MOVF 0x20, W\nADDWF 0x20, W\nADDWF 0x20, W\nMOVWF 0x20\n"
+                         "MOVF 0x20, W\nADDLW 0x01\nMOVWF 0x7F\nMOVF 0x7F, W\nADDWF 0x7F, W\n"
+                         "MOVWF 0x7E\nADDWF 0x7E, W\nMOVWF 0x21")
+        code = self.visit("int a; int b; a = (a * b) * (b * a);").code
+        # The first product waits in a temp while the second is computed
+        self.assertEqual(code[:code.index("__end:")], [
+            "MOVF 0x20, W", "MOVWF 0x7F", "MOVF 0x21, W", "MOVWF 0x7E", "CALL __mul8",
+            "MOVWF 0x7A", "MOVF 0x21, W", "MOVWF 0x7F", "MOVF 0x20, W", "MOVWF 0x7E",
+            "CALL __mul8", "MOVWF 0x7E", "MOVF 0x7A, W", "MOVWF 0x7F", "CALL __mul8",
+            "MOVWF 0x20"])
+        self.assertEqual(code.count("__mul8:"), 1)
+
+    def test_division(self):
+        """Test a constant divisor is a shift sequence and others call __div8,
+        a constant zero included, with each helper linked once"""
+        visitor = self.visit("int a; int b; a = a / 16; b = a / b; a = (b / 0) * b;")
+        code = visitor.code
+        self.assertEqual(code[:code.index("__end:")], [
+            "SWAPF 0x20, W", "ANDLW 0x0F", "MOVWF 0x20",
+            "MOVF 0x20, W", "MOVWF 0x7F", "MOVF 0x21, W", "MOVWF 0x7E", "CALL __div8",
+            "MOVWF 0x21",
+            "MOVF 0x21, W", "MOVWF 0x7F", "MOVLW 0x00", "MOVWF 0x7E", "CALL __div8",
+            "MOVWF 0x7A", "MOVF 0x21, W", "MOVWF 0x79", "CALL __mul8", "MOVWF 0x20"])
+        self.assertEqual([line for line in code if line.startswith("__") and line.endswith("8:")],
+                         ["__div8:", "__mul8:"])
+
+    def test_array_elements(self):
+        """Test arrays take a byte per element, constant indices address an
+        element directly and others go through FSR and INDF"""
+        visitor = self.visit("int m[4]; int i; m[i] = 5; i = m[2]; m[1] = m[i];")
+        self.assertEqual(visitor.var_map, {"m": "0x20", "i": "0x24"})
+        self.assertEqual(visitor.get_code(),
+                         "MOVF 0x24, W\nADDLW 0x20\nMOVWF FSR\nMOVLW 0x05\nMOVWF INDF\n"
+                         "MOVF 0x22, W\nMOVWF 0x24\n"
+                         "MOVF 0x24, W\nADDLW 0x20\nMOVWF FSR\nMOVF INDF, W\nMOVWF 0x21")
+        self.assertEqual(visitor.temps, [])
+
+    def test_unary_minus(self):
+        """Test that unary minus negates its operand's value in W"""
+        visitor = self.visit("int a; int b; a = -b; b = -(a + 2) - -a;")
+        self.assertEqual(visitor.get_code(),
+                         "MOVF 0x21, W\nSUBLW 0x00\nMOVWF 0x20\n"
+                         "MOVF 0x20, W\nADDLW 0x02\nSUBLW 0x00\nMOVWF 0x7F\n"
+                         "MOVF 0x20, W\nSUBLW 0x00\nSUBWF 0x7F, W\nMOVWF 0x21")
+        self.assertNotIn("not implemented", visitor.get_code())
+
+
+class TestASTArena(unittest.TestCase):
+    """Test cases for slotted nodes and the flat arena encoding"""
+
+    code = """
+    int main() {
+        int a;
+        int buf[4];
+        a = -(1 + 2) * buf[a];
+        if (a < 3) { a = 1; } else { while (a) { a = a - 1; } }
+    }
+    """
+
+    def parse(self):
+        return Parser(MiniCLexer(self.code).tokenize()).parse()
+
+    def test_nodes_have_no_instance_dict(self):
+        """Test that every AST node class is slotted"""
+        for node in (Program([], []), Block([], []), Declaration("int", "x"),
+                     AssignmentStatement("x", None, Literal(1)),
+                     IfStatement(Literal(1), Block([], [])),
+                     WhileStatement(Literal(1), Block([], [])),
+                     BinaryOp("+", Literal(1), Literal(2)), UnaryOp("-", Literal(1)),
+                     Identifier("x"), Parenthesized(Literal(1))):
+            self.assertFalse(hasattr(node, "__dict__"), type(node).__name__)
+            self.assertIsNone(node.span)
+
+    def test_parser_records_token_spans(self):
+        """Test that nodes know the token range they were parsed from"""
+        tokens = MiniCLexer("int x; x = (1 + y) * 2;").tokenize()
+        program = Parser(tokens).parse()
+        self.assertEqual(program.span, (0, len(tokens)))
+        self.assertEqual(program.declarations[0].span, (0, 3))
+        assign = program.statements[0]
+        self.assertEqual(assign.span, (3, 13))
+        self.assertEqual(assign.rhs.span, (5, 12))
+        self.assertEqual(assign.rhs.left.span, (5, 10))
+        self.assertEqual(assign.rhs.left.expr.right.span, (8, 9))
+
+    def test_arena_round_trip(self):
+        """Test that the arena view reads back the same tree and spans"""
+        program = self.parse()
+        arena, root = ASTArena.from_tree(program)
+        view = arena.node(root)
+        self.assertIsInstance(view, Program)
+        self.assertEqual(repr(view), repr(program))
+        self.assertEqual(view.span, program.span)
+        if_view = view.statements[1]
+        self.assertIsInstance(if_view, IfStatement)
+        self.assertEqual(if_view.condition.span, program.statements[1].condition.span)
+        self.assertIsNone(view.declarations[0].array_size)
+        self.assertEqual(view.declarations[1].array_size, 4)
+
+    def test_codegen_over_arena_view(self):
+        """Test that the code generator walks arena views like real nodes"""
+        program = self.parse()
+        arena, root = ASTArena.from_tree(program)
+        expected, actual = CodeGenVisitor(), CodeGenVisitor()
+        program.accept(expected)
+        arena.node(root).accept(actual)
+        self.assertEqual(actual.get_code(), expected.get_code())
+
+    def test_arena_is_compact(self):
+        """Test that the arena stores nodes in a few bytes each"""
+        arena, _ = ASTArena.from_tree(self.parse())
+        self.assertLess(arena.nbytes() / len(arena), 32)
+
+class TestASTWalker(unittest.TestCase):
+    """Test cases for the dispatch-table tree walkers"""
+
+    def parse(self, code):
+        return Parser(MiniCLexer(code).tokenize()).parse()
+
+    def test_iter_children_in_source_order(self):
+        """Test that children come out in field order, lists flattened"""
+        program = self.parse("int a; a = 1; if (a) { a = 2; } else { a = 3; }")
+        kinds = [type(c).__name__ for c in iter_children(program)]
+        self.assertEqual(kinds, ["Declaration", "AssignmentStatement", "IfStatement"])
+        if_stmt = program.statements[1]
+        self.assertEqual(list(iter_children(if_stmt)),
+                         [if_stmt.condition, if_stmt.then_block, if_stmt.else_block])
+
+    def test_enter_and_leave_hooks(self):
+        """Test pre/post-order hooks and skipping children"""
+        class Trace(ASTWalker):
+            def __init__(self): self.events = []
+            def enterBinaryOp(self, node): self.events.append(("enter", node.op))
+            def leaveBinaryOp(self, node): self.events.append(("leave", node.op))
+            def enterLiteral(self, node): self.events.append(("lit", node.value))
+            def enterWhile(self, node): return False
+
+        program = self.parse("x = (1 + 2) * 3; while (x) { x = 4 - 5; }")
+        trace = Trace()
+        trace.walk(program)
+        self.assertEqual(trace.events, [
+            ("enter", "*"), ("enter", "+"), ("lit", 1), ("lit", 2), ("leave", "+"),
+            ("lit", 3), ("leave", "*"),
+        ])
+
+    def test_dispatch_table_is_per_class(self):
+        """Test that handlers are resolved once per walker subclass"""
+        class Counter(ASTWalker):
+            def enterIdentifier(self, node): pass
+        self.assertIsNotNone(Counter.dispatch[Identifier][1])
+        self.assertIsNone(Counter.dispatch[Literal][1])
+        self.assertIs(CodeGenVisitor.dispatch[BinaryOp][0], CodeGenVisitor.walkBinaryOp)
+
+    def test_transformer_replaces_nodes(self):
+        """Test that leave hooks can return replacement nodes"""
+        class StripParens(ASTTransformer):
+            def leaveParenthesized(self, node): return node.expr
+
+        program = self.parse("x = ((1 + (y))) * (2);")
+        program = StripParens().transform(program)
+        self.assertEqual(repr(program.statements[0].rhs),
+                         repr(BinaryOp("*", BinaryOp("+", Literal(1), Identifier("y")), Literal(2))))
+
+    def test_fused_walkers_share_one_traversal(self):
+        """Test that several hook walkers can run in a single pass"""
+        class Names(ASTWalker):
+            def __init__(self): self.names = []
+            def enterIdentifier(self, node): self.names.append(node.name)
+        class Depth(ASTWalker):
+            def __init__(self): self.depth = self.max_depth = 0
+            def enterBlock(self, node):
+                self.depth += 1; self.max_depth = max(self.max_depth, self.depth)
+            def leaveBlock(self, node): self.depth -= 1
+
+        names, depth = Names(), Depth()
+        FusedWalker(names, depth).walk(self.parse("a = b; if (c) { { d = e; } }"))
+        self.assertEqual(names.names, ["b", "c", "e"])
+        self.assertEqual((depth.depth, depth.max_depth), (0, 2))
+
+class TestCompilerDriver(unittest.TestCase):
+    """Test cases for the compile_source / compile_file entry points"""
+
+    def write_source(self, data):
+        fd, path = tempfile.mkstemp(suffix=".c")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_compile_file_matches_compile_source(self):
+        """Test that the memory-mapped path produces the same assembly"""
+        code = "int main() {\n  int a;\n  a = 5 + 3;\n  while (a < 9) { a = a + 1; }\n}\n"
+        path = self.write_source(code.encode())
+        self.assertEqual(compile_file(path), compile_source(code))
+
+    def test_compile_empty_file(self):
+        """Test that an empty file compiles to no code"""
+        self.assertEqual(compile_file(self.write_source(b"")), "")
+
+    def test_compile_file_syntax_error(self):
+        """Test that syntax errors in a mapped file report line/col"""
+        path = self.write_source(b"int x;\nx = ;")
+        with self.assertRaises(ParsingException) as ctx:
+            compile_file(path)
+        self.assertIn("line 2, col 5", str(ctx.exception))
+
+    def test_compile_source_recover_lists_all_errors(self):
+        """Test that recovery mode raises once with every diagnostic"""
+        with self.assertRaises(ParsingException) as ctx:
+            compile_source("x = ;\ny = 1 2;\nz = 3;", recover=True)
+        self.assertEqual([(d.line, d.col) for d in ctx.exception.diagnostics], [(1, 5), (2, 7)])
+        self.assertEqual(str(ctx.exception).count("\n"), 1)
+
+    def test_main_reports_all_errors(self):
+        """Test that the command line prints every syntax error in one run"""
+        from compilation import main
+        path = self.write_source(b"int x;\nx = ;\nx = 1 2;\nx = 3;\n")
+        err = StringIO()
+        old_err, sys.stderr = sys.stderr, err
+        try:
+            self.assertEqual(main([path]), 1)
+        finally:
+            sys.stderr = old_err
+        lines = err.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(f"{path}:2:5: error: "))
+        self.assertTrue(lines[1].startswith(f"{path}:3:7: error: "))
+
+    def test_deeply_nested_program(self):
+        """Test code generation for nesting deeper than the recursion limit"""
+        depth = 5000
+        expr = Literal(1)
+        for _ in range(depth):
+            expr = BinaryOp("+", Identifier("x"), Parenthesized(expr))
+        body = Block([], [AssignmentStatement("x", None, expr)])
+        for _ in range(depth):
+            body = Block([], [IfStatement(Identifier("x"), body)])
+        visitor = CodeGenVisitor()
+        Program([Declaration("int", "x")], [body]).accept(visitor)
+        code = visitor.code
+        self.assertEqual(code.count("ADDWF 0x20, W"), depth - 1)
+        self.assertEqual(code.count("ADDLW 0x01"), 1)
+        self.assertEqual(visitor.temps, [])
+        self.assertEqual(code[-1], "ifend1:")
+        self.assertEqual(code.count(f"GOTO else{2 * depth - 2}"), 1)
+
+class TestIncrementalParser(unittest.TestCase):
+    """Test re-lexing and re-parsing only the edited part of a source"""
+
+    source = """int main() {
+    int x;
+    int y;
+    x = 1;
+    if (x > 2) { y = x + 3; } else { y = 0; }
+    while (y) { y = y - 1; }
+}"""
+
+    def dump(self, node):
+        """Node classes, fields and spans as nested tuples"""
+        if isinstance(node, list):
+            return [self.dump(n) for n in node]
+        if not hasattr(node, 'span'):
+            return node
+        return (type(node).__name__, node.span,
+                tuple(self.dump(getattr(node, f)) for f in type(node).__slots__))
+
+    def assertMatchesFullParse(self, inc):
+        tokens = MiniCLexer(inc.code).tokenize_compact()
+        self.assertEqual(list(inc.tokens.types), list(tokens.types))
+        self.assertEqual(list(inc.tokens.starts), list(tokens.starts))
+        self.assertEqual(list(inc.tokens.ends), list(tokens.ends))
+        self.assertEqual(inc.kinds, tokens.kinds())
+        self.assertEqual(self.dump(inc.program), self.dump(IterativeParser(tokens).parse()))
+
+    def replace(self, inc, old, new):
+        start = inc.code.index(old)
+        return inc.edit(start, start + len(old), new)
+
+    def test_edit_reparses_only_enclosing_statement(self):
+        """Test that an edit inside one assignment re-parses just that assignment"""
+        inc = IncrementalParser(self.source)
+        program = inc.program
+        if_stmt, while_stmt = program.statements[1], program.statements[2]
+        self.replace(inc, "x = 1;", "x = 100 + 2;")
+        self.assertEqual(inc.reparsed, "Assignment")
+        self.assertEqual(inc.relexed, 6)
+        self.assertIs(inc.program, program)
+        self.assertIs(program.statements[1], if_stmt)
+        self.assertIs(program.statements[2], while_stmt)
+        self.assertMatchesFullParse(inc)
+
+    def test_edit_inside_nested_block(self):
+        """Test that unchanged siblings are reused and their spans shifted"""
+        inc = IncrementalParser(self.source)
+        else_block = inc.program.statements[1].else_block
+        self.replace(inc, "y = x + 3;", "y = x + 3; x = y;")
+        self.assertEqual(inc.reparsed, "Block")
+        self.assertIs(inc.program.statements[1].else_block, else_block)
+        self.assertMatchesFullParse(inc)
+
+    def test_edit_changing_statement_kind(self):
+        """Test that a statement can turn into a different kind of statement"""
+        inc = IncrementalParser(self.source)
+        self.replace(inc, " else { y = 0; }", "")
+        self.replace(inc, "if (x > 2)", "while (x > 2)")
+        self.assertMatchesFullParse(inc)
+        self.assertIsInstance(inc.program.statements[1], WhileStatement)
+
+    def test_edit_widens_to_enclosing_block(self):
+        """Test that an edit turning a statement into a declaration re-parses wider"""
+        inc = IncrementalParser("int main() { int x; { x = 1; } }")
+        self.replace(inc, "x = 1;", "int y; x = 1;")
+        self.assertEqual(inc.reparsed, "Block")
+        self.assertMatchesFullParse(inc)
+
+    def test_whitespace_edit_reuses_tree(self):
+        """Test that an edit leaving the tokens unchanged keeps the whole tree"""
+        inc = IncrementalParser(self.source)
+        before = self.dump(inc.program)
+        start = inc.code.index("\n    if")
+        inc.edit(start, start, "  // one\n")
+        self.assertIsNone(inc.reparsed)
+        self.assertEqual(self.dump(inc.program), before)
+
+    def test_edit_opening_comment(self):
+        """Test that closing an earlier unterminated /* relexes from the opener"""
+        inc = IncrementalParser("x = 6 / 2; y = 1;")
+        with self.assertRaises(ParsingException):
+            self.replace(inc, "/", "/*")
+        self.replace(inc, " y = 1;", " */ + 2;")
+        self.assertEqual(inc.code, "x = 6 /* 2; */ + 2;")
+        self.assertMatchesFullParse(inc)
+
+    def test_syntax_error_and_recovery(self):
+        """Test that a broken edit raises and the next valid edit parses again"""
+        inc = IncrementalParser(self.source)
+        with self.assertRaises(ParsingException):
+            self.replace(inc, "x = 1;", "x = ;")
+        self.assertIsNone(inc.program)
+        self.replace(inc, "x = ;", "x = 5;")
+        self.assertMatchesFullParse(inc)
+
+    def test_random_edits_match_full_parse(self):
+        """Test a stream of random edits against a full re-lex and re-parse"""
+        import random
+        rng = random.Random(9)
+        snippets = ["1", "x", "+", "*", ";", "{", "}", " ", "if", "else", "y = 2;",
+                    "/*", "*/", "\n", "while (y) { y = 0; }"]
+        inc = IncrementalParser(self.source)
+        for _ in range(500):
+            code = inc.code
+            start = rng.randint(0, len(code))
+            end = min(len(code), start + rng.choice([0, 1, 3]))
+            text = "".join(rng.choice(snippets) for _ in range(rng.randint(0, 2)))
+            new_code = code[:start] + text + code[end:]
+            try:
+                IterativeParser(MiniCLexer(new_code).tokenize_compact()).parse()
+            except ParsingException:
+                with self.assertRaises(ParsingException):
+                    inc.edit(start, end, text)
+                inc = IncrementalParser(code)   # drop the broken edit
+                continue
+            inc.edit(start, end, text)
+            self.assertMatchesFullParse(inc)
+
+class TestConstantFolder(unittest.TestCase):
+    """Test the constant folding and algebraic simplification pass"""
+
+    def fold(self, expr, declarations=""):
+        program = Parser(MiniCLexer(f"{declarations}x = {expr};").tokenize()).parse()
+        folder = ConstantFolder()
+        return folder.transform(program).statements[0].rhs, folder
+
+    def test_fold_constant_arithmetic(self):
+        """Test that constant subtrees collapse into a single literal"""
+        rhs, folder = self.fold("(2 + 3) * 4")
+        self.assertEqual(repr(rhs), repr(Literal(20)))
+        self.assertEqual(rhs.span, (2, 9))
+        self.assertEqual(folder.folded, 3)
+
+    def test_fold_in_operand_width(self):
+        """Test that folded values wrap like bytes unless an operand is an
+        int, which wraps at 16 bits and compares signed"""
+        for expr, value in (("200 + 100", 44), ("1 - 2", 0xFF), ("-1", 0xFF),
+                            ("200 * 2 / 2", 72), ("0 - 1 < 1", 0), ("(0 - 7) / 2", 124),
+                            ("256 * 257", 256), ("65535 + 3", 2), ("300 - 301", 0xFFFF),
+                            ("300 - 301 > 1", 0), ("(300 - 307) / 2", 0xFFFD),
+                            ("256 - 1 + 1", 256), ("-(256 - 1)", 0xFF01)):
+            rhs, _ = self.fold(expr)
+            self.assertEqual(rhs.value, value, expr)
+
+    def test_int_below_256_kept_beside_byte(self):
+        """Test that an int constant below 256 is not made a char literal
+        where a byte operand would then wrap, and the identities keep types"""
+        rhs, folder = self.fold("c + (256 - 1)", "char c; ")
+        self.assertEqual(repr(rhs), "BinaryOp(+, Identifier(c, idx=None), "
+                                    "Paren(BinaryOp(-, Literal(256), Literal(1))))")
+        self.assertEqual(folder.folded, 0)
+        rhs, _ = self.fold("i + (256 - 1)", "int i; ")
+        self.assertEqual(repr(rhs), "BinaryOp(+, Identifier(i, idx=None), Literal(255))")
+        rhs, _ = self.fold("c + (256 - 256)", "char c; ")
+        self.assertEqual(rhs.kind, "BinaryOp")
+        rhs, _ = self.fold("i * 0 + c", "int i; char c; ")
+        self.assertEqual(repr(rhs.right), "Identifier(c, idx=None)")
+        for expr, value in (("(256 - 1) + (256 - 2)", 509), ("(256 - 1)", 255)):
+            rhs, _ = self.fold(expr)
+            self.assertEqual(repr(rhs), repr(Literal(value)), expr)
+
+    def test_fold_comparisons_and_logic(self):
+        """Test that comparisons and logical operators fold to 1/0"""
+        for expr, value in (("3 < 4", 1), ("3 >= 4", 0), ("2 == 2", 1), ("2 != 2", 0),
+                            ("1 && 0", 0), ("0 || 5", 1), ("!0", 1), ("!7", 0)):
+            rhs, _ = self.fold(expr)
+            self.assertEqual(rhs.value, value, expr)
+
+    def test_algebraic_identities(self):
+        """Test x+0, x*1, x*0 and friends"""
+        for expr in ("y + 0", "0 + y", "y - 0", "y * 1", "1 * y", "y / 1", "y + (2 - 2)"):
+            rhs, _ = self.fold(expr)
+            self.assertEqual(repr(rhs), repr(Identifier("y")), expr)
+        for expr, value in (("y * 0", 0), ("0 * y[2]", 0), ("y && 0", 0), ("1 || y", 1)):
+            rhs, _ = self.fold(expr)
+            self.assertEqual(repr(rhs), repr(Literal(value)), expr)
+
+    def test_non_constant_left_alone(self):
+        """Test that runtime values and division by zero are not folded"""
+        for expr in ("y + 1", "0 - y", "y / 0", "4 / 0", "(y)"):
+            rhs, folder = self.fold(expr)
+            original = Parser(MiniCLexer(f"x = {expr};").tokenize()).parse().statements[0].rhs
+            self.assertEqual(repr(rhs), repr(original), expr)
+            self.assertEqual(folder.folded, 0)
+
+    def test_compile_source_folds(self):
+        """Test that the driver folds before generating code"""
+        self.assertEqual(compile_source("char a; a = (2 + 3) * 4;", dce=False),
+                         "MOVLW 0x14\nMOVWF 0x20")
+        self.assertEqual(compile_source("char a; char b; a = b * 1 + 0;", dce=False),
+                         "MOVF 0x21, W\nMOVWF 0x20")
+
+class TestPeepholeOptimizer(unittest.TestCase):
+    """Test the table-driven clean-up of emitted assembly"""
+
+    def optimize(self, text, window=8):
+        optimizer = PeepholeOptimizer(window)
+        return "\n".join(optimizer.optimize(text.split("\n"))), optimizer
+
+    def test_asm_line_fields(self):
+        """Test that lines parse into fields and print back unchanged"""
+        line = AsmLine.parse("ADDWF 0x21, W")
+        self.assertEqual((line.op, line.args, line.words, line.cycles), ("ADDWF", ("0x21", "W"), 1, 1))
+        self.assertEqual(AsmLine.parse("GOTO wend1").target, "wend1")
+        self.assertEqual(AsmLine.parse("GOTO wend1").cycles, 2)
+        self.assertEqual(AsmLine.parse("else0:").label, "else0")
+        self.assertEqual(AsmLine.parse("; MULT not implemented").words, 0)
+        for text in ("ADDWF 0x21, W", "CLRW", "wend1:", "; note", "MOVF 0x20, W ; load"):
+            self.assertEqual(str(AsmLine.parse(text)), text)
+
+    def test_store_reload(self):
+        """Test that reloading the register just stored is dropped"""
+        code, optimizer = self.optimize("MOVF 0x20, W\nMOVWF 0x21\nMOVF 0x21, W\nMOVWF 0x22")
+        self.assertEqual(code, "MOVF 0x20, W\nMOVWF 0x21\nMOVWF 0x22")
+        self.assertEqual(optimizer.stats["store_reload"], [1, 1, 1])
+
+    def test_store_reload_keeps_needed_reloads(self):
+        """Test that the reload stays when its Z flag, a skip or an SFR depends on it"""
+        for text in ("MOVWF 0x21\nMOVF 0x21, W\nBTFSC STATUS, Z\nGOTO done\nCLRW\ndone:",
+                     "BTFSC STATUS, C\nMOVWF 0x21\nMOVF 0x21, W\nMOVWF 0x22",
+                     "MOVWF INDF\nMOVF INDF, W\nMOVWF 0x22",
+                     "MOVWF 0x05\nMOVF 0x05, W\nMOVWF 0x22",
+                     "MOVWF 0x21\nMOVF 0x22, W"):
+            self.assertEqual(self.optimize(text)[0], text)
+
+    def test_goto_next(self):
+        """Test that a jump to the following label falls through instead"""
+        code, optimizer = self.optimize("GOTO ifend1\nelse0:\nifend1:\nMOVLW 0x01\nGOTO else0")
+        self.assertEqual(code, "else0:\nMOVLW 0x01\nGOTO else0")
+        self.assertEqual(optimizer.stats["goto_next"], [1, 1, 2])
+        code, optimizer = self.optimize("MOVF 0x20, F\nBTFSC STATUS, Z\nGOTO else0\nelse0:")
+        self.assertEqual(code, "MOVF 0x20, F")
+        self.assertEqual(optimizer.stats["goto_next"], [1, 2, 3])
+        text = "DECFSZ 0x20, F\nGOTO next\nnext:\nGOTO next"
+        self.assertEqual(self.optimize(text)[0], text)
+
+    def test_window(self):
+        """Test that a rule looks no further ahead than the window"""
+        text = "GOTO end\na:\nb:\nend:\nCLRW\nGOTO a\nGOTO b"
+        self.assertEqual(self.optimize(text, window=2)[0], text)
+        self.assertEqual(self.optimize(text, window=3)[0], "a:\nb:\nCLRW\nGOTO a\nGOTO b")
+
+    def test_thread_jump(self):
+        """Test that jumps to jumps go straight to the final target"""
+        code, optimizer = self.optimize(
+            "BTFSC STATUS, Z\nGOTO a\nMOVLW 0x01\nGOTO b\na:\nGOTO b\nMOVLW 0x02\nb:\nGOTO c\nc:\nCLRW")
+        self.assertEqual(code, "BTFSC STATUS, Z\nGOTO c\nMOVLW 0x01\nGOTO c\n"
+                               "GOTO c\nMOVLW 0x02\nc:\nCLRW")
+        self.assertEqual(optimizer.stats["thread_jump"], [3, 0, 8])
+        # A loop of jumps is left alone
+        text = "a:\nGOTO b\nCLRW\nb:\nGOTO a"
+        self.assertEqual(self.optimize(text)[0], text)
+
+    def test_unused_labels(self):
+        """Test that only labels nothing jumps to are removed"""
+        code, optimizer = self.optimize("top:\nMOVLW 0x01\nmid:\nGOTO top")
+        self.assertEqual(code, "top:\nMOVLW 0x01\nGOTO top")
+        self.assertEqual(optimizer.stats["unused_label"], [1, 0, 0])
+
+    def test_fixed_point(self):
+        """Test that rewrites enable each other until nothing changes"""
+        visitor = CodeGenVisitor()
+        program = Parser(MiniCLexer(
+            "int x; int y; x = y; y = x; while (x) { if (y) { x = 0; } }").tokenize()).parse()
+        program.accept(visitor)
+        optimizer = PeepholeOptimizer()
+        code = optimizer.optimize(visitor.code)
+        self.assertEqual("\n".join(code),
+                         "MOVF 0x21, W\nMOVWF 0x20\nMOVWF 0x21\n"
+                         "while0:\nMOVF 0x20, F\nBTFSC STATUS, Z\nGOTO wend1\n"
+                         "MOVF 0x21, F\nBTFSC STATUS, Z\nGOTO while0\n"
+                         "MOVLW 0x00\nMOVWF 0x20\nGOTO while0\nwend1:")
+        again = PeepholeOptimizer()
+        self.assertEqual(again.optimize(code), code)
+        self.assertEqual(again.sweeps, 1)
+
+    def test_compile_source_runs_peephole(self):
+        """Test the driver's peephole switch and savings report"""
+        source = "char x; char y; x = 3; y = x;"
+        self.assertEqual(compile_source(source, peephole=False, dce=False),
+                         "MOVLW 0x03\nMOVWF 0x20\nMOVF 0x20, W\nMOVWF 0x21")
+        out = StringIO()
+        self.assertEqual(compile_source(source, report=out, dce=False), "MOVLW 0x03\nMOVWF 0x20\nMOVWF 0x21")
+        self.assertIn("peephole store_reload: 1 rewrites, 1 instructions, 1 cycles saved",
+                      out.getvalue().splitlines())
+
+class TestIRPipeline(unittest.TestCase):
+    """Test lowering to IR, the CFG, instruction selection and the pass manager"""
+
+    source = "int x; int y; while (x < 5 && y) { x = x + (y - 1); } y = x == 3;"
+
+    def lower(self, code):
+        program = IterativeParser(MiniCLexer(code).tokenize()).parse()
+        return program, lower_to_ir(program).link()
+
+    def test_three_address_dump(self):
+        """Test the IR is split into labelled basic blocks"""
+        _, ir = self.lower(self.source)
+        self.assertEqual(str(ir),
+                         "; block 0\n  decl x\n  decl y\n  goto wtest2\n"
+                         "while0:\n  %1 = y - 1\n  x = x + %1\n"
+                         "wtest2:\n  ifnot x < 5 goto skip3\n"
+                         "; block 3\n  if bool y goto while0\n"
+                         "skip3:\nwend1:\n  y = x == 3")
+        self.assertIsInstance(ir.blocks[0].term, IRJump)
+        self.assertIsInstance(ir.blocks[3].term, IRBranch)
+
+    def test_control_flow_graph(self):
+        """Test successors and predecessors, including fallthrough edges"""
+        _, ir = self.lower(self.source)
+        entry, body, test, second, skip, end = ir.blocks
+        self.assertEqual(entry.succs, [test])
+        self.assertEqual(body.succs, [test])
+        self.assertEqual(test.succs, [skip, second])
+        self.assertEqual(second.succs, [body, skip])
+        self.assertEqual(skip.succs, [end])
+        self.assertEqual(end.succs, [])
+        self.assertEqual(test.preds, [entry, body])
+        self.assertEqual(body.preds, [second])
+
+    def test_selection_matches_code_generator(self):
+        """Test instruction selection reproduces CodeGenVisitor's text"""
+        # Loops are laid out differently, rotated to test at the bottom
+        programs = [
+            "char x; char y; if (x < 5 && y) { x = x + (y - 1); } y = x == 3;",
+            "char a; char b; char c; a = (a + b) - (b + c); b = (a - 1) + (c + 2);",
+            "char a; char b; if ((a + 1) >= (b + 2) || !(a != b)) { a = 0; } else { b = a > 7; }",
+            "char a; char b; a = (a && b) + (a || b); if (!a) { b = b - a; }",
+            "x = y + z; if (w) { z = x; v = y - z; }",
+        ]
+        for code in programs:
+            program, ir = self.lower(code)
+            cg = CodeGenVisitor()
+            program.accept(cg)
+            self.assertEqual(select_instructions(ir), cg.code, code)
+
+    def test_pass_manager_times_each_pass(self):
+        """Test passes run in order and each gets a timing line"""
+        calls = []
+        passes = PassManager([("double", lambda n: calls.append("double") or n * 2)])
+        passes.add("inc", lambda n: calls.append("inc") or n + 1)
+        self.assertEqual(passes.run(5), 11)
+        self.assertEqual(calls, ["double", "inc"])
+        self.assertEqual([name for name, _ in passes.timings], ["double", "inc"])
+        report = passes.report()
+        self.assertTrue(report[0].startswith("double: ") and report[0].endswith(" ms"))
+
+    def test_compile_source_reports_passes(self):
+        """Test the driver's pipeline and its timing report"""
+        out = StringIO()
+        compile_source(self.source, report=out)
+        names = [line.split(":")[0] for line in out.getvalue().splitlines()
+                 if line.startswith("pass ")]
+        self.assertEqual(names, ["pass fold", "pass lower", "pass types", "pass cfg", "pass dce",
+                                 "pass ranges", "pass licm", "pass alloc", "pass select", "pass peephole", "pass banks",
+                                 "pass listing"])
+
+class TestDeadCodeEliminator(unittest.TestCase):
+    """Test removal of unreachable blocks, dead stores and unused variables"""
+
+    def eliminate(self, code):
+        program = ConstantFolder().transform(IterativeParser(MiniCLexer(code).tokenize()).parse())
+        ir = lower_to_ir(program).link()
+        eliminator = DeadCodeEliminator()
+        return ir, eliminator.run(ir), eliminator
+
+    def test_unreachable_blocks(self):
+        """Test while (0) and if (0) bodies are dropped"""
+        ir, out, eliminator = self.eliminate(
+            "int a; int b; while (0) { a = 1; } if (0) { b = 2; } if (a) { b = b + 1; }")
+        self.assertEqual(len(ir.blocks) - len(out.blocks), 2)
+        self.assertEqual(eliminator.stats["unreachable blocks"], 2)
+        code = select_instructions(out)
+        self.assertNotIn("MOVLW 0x01", code)
+        self.assertNotIn("MOVLW 0x02", code)
+        self.assertIn("ADDLW 0x01", code)
+
+    def test_dead_store_chain(self):
+        """Test a store whose variable is never read goes, and so do its inputs"""
+        _, out, eliminator = self.eliminate(
+            "int t; int u; int x; t = 5; u = t + 1; x = 3; if (x) { }")
+        self.assertEqual(eliminator.stats["dead instructions"], 2)
+        self.assertEqual(eliminator.stats["unused variables"], 2)
+        # t and u never reach alloc_var, so x takes the first byte
+        self.assertEqual(select_instructions(out)[:2], ["MOVLW 0x03", "MOVWF 0x20"])
+
+    def test_live_code_is_kept(self):
+        """Test a loop whose variables are all read is left alone"""
+        ir, out, eliminator = self.eliminate("int n; n = 0; while (n < 3) { n = n + 1; }")
+        self.assertEqual(str(out), str(ir))
+        self.assertEqual(select_instructions(out), select_instructions(ir))
+        self.assertEqual(sum(eliminator.stats.values()), 0)
+
+    def test_input_is_unchanged(self):
+        """Test run() returns a new program rather than editing its input"""
+        ir, out, _ = self.eliminate("int a; int b; a = 1; b = 2; if (b) { }")
+        self.assertEqual(str(ir).count("decl"), 2)
+        self.assertEqual(str(out).count("decl"), 1)
+        self.assertIsNot(out.blocks[0], ir.blocks[0])
+        self.assertTrue(all(succ in out.blocks for block in out.blocks for succ in block.succs))
+
+    def test_report_reclaimed(self):
+        """Test words and bytes reclaimed are measured on the selected code"""
+        _, _, eliminator = self.eliminate(
+            "char t; char u; char x; t = 5; u = t + 1; x = 3; if (x) { }")
+        self.assertEqual(eliminator.report(),
+                         ["unreachable blocks: 0 removed", "dead instructions: 2 removed",
+                          "unused variables: 2 removed", "reclaimed: 5 words, 2 bytes"])
+
+    def test_compile_source_switch(self):
+        """Test the driver runs the pass unless dce=False"""
+        source = "char a; char b; a = 4; b = a;"
+        self.assertEqual(compile_source(source), "")
+        self.assertEqual(compile_source(source, dce=False), "MOVLW 0x04\nMOVWF 0x20\nMOVWF 0x21")
+        out = StringIO()
+        compile_source(source, report=out)
+        self.assertIn("dce reclaimed: 4 words, 2 bytes", out.getvalue().splitlines())
+
+class TestRamAllocator(unittest.TestCase):
+    """Test overlaying block-scoped variables and the memory map"""
+
+    def memory_map(self, code):
+        out = StringIO()
+        asm = compile_source(code, memory_map=out)
+        return asm, out.getvalue().splitlines()
+
+    def test_sibling_blocks_share_a_byte(self):
+        """Test variables of an if's two arms are overlaid"""
+        asm, lines = self.memory_map(
+            "char a; char b; a = 3; if (a) { char t; t = a + 1; b = t + t; } "
+            "else { char u; u = a - 1; b = u; } if (b) { }")
+        self.assertEqual(lines, ["0x20  a", "0x21  b", "0x22  t.1, u.1",
+                                 "3 of 368 bytes used, 1 saved by overlaying"])
+        self.assertIn("ADDWF 0x22, W", asm.splitlines())
+
+    def test_live_variables_interfere(self):
+        """Test variables live at the same time get their own bytes"""
+        _, lines = self.memory_map(
+            "char a; if (a) { char t; char u; t = a; u = a + 1; a = t + u; } if (a) { }")
+        self.assertEqual(lines[:3], ["0x20  a", "0x21  t.1", "0x22  u.1"])
+
+    def test_loop_carried_value_is_kept(self):
+        """Test a variable read around a loop back edge is not overlaid"""
+        program = IterativeParser(MiniCLexer(
+            "char a; if (a) { char s; char t; s = 0; while (a) { t = a; s = s + t; a = a - 1; } "
+            "a = s; } if (a) { }").tokenize()).parse()
+        ir = lower_to_ir(program).link()
+        RamAllocator().run(ir)
+        self.assertEqual(ir.var_map, {"s.1": "0x21", "t.1": "0x22"})
+
+    def test_shadowing_declaration(self):
+        """Test an inner declaration does not write the outer variable"""
+        program = IterativeParser(MiniCLexer(
+            "int a; a = 1; if (a) { int a; a = 5; if (a) { } }").tokenize()).parse()
+        ir = lower_to_ir(program)
+        self.assertIn("  a.1 = 5", str(ir).splitlines())
+        self.assertEqual(ir.locals, {"a.1"})
+
+    def test_top_level_variables_are_not_overlaid(self):
+        """Test variables declared at the top level keep a byte each"""
+        _, lines = self.memory_map("char a; char b; a = 1; b = a; if (b) { }")
+        self.assertEqual(lines, ["0x20  a", "0x21  b", "2 of 368 bytes used, 0 saved by overlaying"])
+
+    def test_out_of_ram(self):
+        """Test more variables than every bank holds is a clear error"""
+        names = [f"v{i}" for i in range(369)]
+        code = "".join(f"char {n}; " for n in names) + f"if ({' + '.join(names)}) {{ }}"
+        with self.assertRaises(AllocationException) as ctx:
+            compile_source(code)
+        self.assertEqual(str(ctx.exception),
+                         "out of RAM: 369 variables and 0 temporaries need more than "
+                         "the 368 bytes of RAM")
+
+    def test_temporaries_stay_in_common_ram(self):
+        """Test temporaries never go to banked RAM, with over 80 variables"""
+        fill = [f"f{i}" for i in range(100)]
+        def source(body):
+            return ("".join(f"char {n}; " for n in fill) + "int a; int b; int t; " + body
+                    + "".join(f"{n} = 1; " for n in fill)
+                    + f"if ({' + '.join(fill + ['a', 'b'])}) {{ }}")
+        # The 16-bit helpers' registers alone fill common RAM
+        with self.assertRaises(AllocationException) as ctx:
+            compile_source(source("a = a * b; b = a / b; t = 65531; a = t + a; "))
+        self.assertEqual(str(ctx.exception),
+                         "out of RAM: 20 temporaries need more than the 16 bytes of common "
+                         "RAM once 103 variables fill bank 0")
+        out = StringIO()
+        compile_source(source("a = a * b; t = 65531; a = t + a; "), memory_map=out)
+        places = [line.split("  ") for line in out.getvalue().splitlines()[:-1]]
+        temps = [addr for addr, name in places if name == "(temporary)" or "__" in name]
+        self.assertEqual(len(temps), 11)
+        self.assertTrue(all(register_bank(addr) is None for addr in temps))
+        self.assertEqual(register_bank(dict((name, addr) for addr, name in places)["t"]), 1)
+
+    def test_main_prints_memory_map(self):
+        """Test the command line's --map option"""
+        from compilation import main
+        fd, path = tempfile.mkstemp(suffix=".c")
+        with os.fdopen(fd, "w") as f:
+            f.write("char a; a = 1; if (a) { }")
+        self.addCleanup(os.remove, path)
+        err, out = StringIO(), StringIO()
+        old_err, old_out, sys.stderr, sys.stdout = sys.stderr, sys.stdout, err, out
+        try:
+            self.assertEqual(main([path, "--map"]), 0)
+        finally:
+            sys.stderr, sys.stdout = old_err, old_out
+        self.assertEqual(err.getvalue().splitlines(),
+                         ["0x20  a", "1 of 368 bytes used, 0 saved by overlaying"])
+
+class TestBankSelection(unittest.TestCase):
+    """Test bank-aware placement and BANKSEL tracking"""
+
+    def test_register_bank(self):
+        """Test which operands need a bank selected"""
+        self.assertEqual([register_bank(op) for op in ("0x20", "0xA0", "0x110", "0x1EF")],
+                         [0, 1, 2, 3])
+        # Common RAM, mirrored SFRs and named registers work from any bank
+        self.assertEqual([register_bank(op) for op in ("0x70", "0xFF", "0x83", "STATUS")],
+                         [None, None, None, None])
+
+    def test_banksel_only_on_change(self):
+        """Test a BANKSEL goes in only where the bank changes"""
+        selector = BankSelector()
+        self.assertEqual(selector.run(["MOVF 0xA0, W", "MOVWF 0xA1", "MOVWF 0x70", "MOVWF 0x20"]),
+                         ["BANKSEL 0xA0", "MOVF 0xA0, W", "MOVWF 0xA1", "MOVWF 0x70",
+                          "BANKSEL 0x20", "MOVWF 0x20"])
+        self.assertEqual(selector.run(["MOVF 0x20, W", "MOVWF 0x21"]), ["MOVF 0x20, W", "MOVWF 0x21"])
+
+    def test_paths_merge_at_labels(self):
+        """Test a label keeps the bank only when every path into it agrees"""
+        code = ["MOVF 0x20, F", "BTFSC STATUS, Z", "GOTO l1", "MOVWF 0xA0", "GOTO l2",
+                "l1:", "MOVWF {}", "l2:", "MOVWF 0xA3"]
+        agree = [line.format("0xA2") for line in code]
+        self.assertEqual(BankSelector().run(agree),
+                         agree[:3] + ["BANKSEL 0xA0"] + agree[3:6] + ["BANKSEL 0xA2"] + agree[6:])
+        differ = [line.format("0x21") for line in code]
+        self.assertEqual(BankSelector().run(differ),
+                         differ[:3] + ["BANKSEL 0xA0"] + differ[3:8] + ["BANKSEL 0xA3"] + differ[8:])
+
+    def test_loop_back_edge(self):
+        """Test the bank at the end of a loop body reaches its head"""
+        selector = BankSelector()
+        # Bank 0 on entry, bank 1 round the back edge: the head cannot know
+        self.assertEqual(selector.run(["loop:", "MOVF 0xA0, W", "ADDWF 0xA1, W", "GOTO loop"]),
+                         ["loop:", "BANKSEL 0xA0", "MOVF 0xA0, W", "ADDWF 0xA1, W", "GOTO loop"])
+        self.assertEqual(selector.run(["BANKSEL 0xA0", "loop:", "MOVF 0xA0, W", "GOTO loop"]),
+                         ["BANKSEL 0xA0", "loop:", "MOVF 0xA0, W", "GOTO loop"])
+
+    def test_skip_and_redundant_banksel(self):
+        """Test a skipped access is banked before its skip, and a repeat BANKSEL goes"""
+        selector = BankSelector()
+        self.assertEqual(selector.run(["BTFSC STATUS, Z", "INCF 0xA0, F", "BANKSEL 0xA0",
+                                       "MOVWF 0xA1"]),
+                         ["BANKSEL 0xA0", "BTFSC STATUS, Z", "INCF 0xA0, F", "MOVWF 0xA1"])
+        self.assertEqual(selector.report(), ["1 inserted, 1 redundant removed, 2 words"])
+        self.assertEqual((AsmLine.parse("BANKSEL 0xA0").words, AsmLine.parse("BANKSEL 0xA0").cycles),
+                         (2, 2))
+
+    def test_skip_guarding_another_bank(self):
+        """Test a skip whose guarded instruction needs another bank jumps round it"""
+        self.assertEqual(BankSelector().run(["CLRF 0x7F", "BTFSC 0xB9, 7", "DECF 0x6F, F",
+                                             "MOVF 0x6F, W"]),
+                         ["CLRF 0x7F", "BANKSEL 0xB9", "BTFSS 0xB9, 7", "GOTO bankskip1",
+                          "BANKSEL 0x6F", "DECF 0x6F, F", "bankskip1:", "BANKSEL 0x6F",
+                          "MOVF 0x6F, W"])
+        # DECFSZ has no opposite, so it picks between two jumps
+        self.assertEqual(BankSelector().run(["DECFSZ 0xA0, F", "INCF 0x20, F"]),
+                         ["BANKSEL 0xA0", "DECFSZ 0xA0, F", "GOTO bankrun0", "GOTO bankskip0",
+                          "bankrun0:", "BANKSEL 0x20", "INCF 0x20, F", "bankskip0:"])
+
+    def test_hot_variables_stay_unbanked(self):
+        """Test loop variables take common RAM once bank 0 is full"""
+        fill = [f"f{i}" for i in range(100)]
+        code = ("".join(f"char {n}; " for n in fill + ["i", "s"])
+                + "i = 5; while (i) { s = s + f0; i = i - 1; } "
+                + f"if ({' + '.join(fill + ['i', 's'])}) {{ }}")
+        out = StringIO()
+        asm = compile_source(code, memory_map=out).splitlines()
+        places = dict(reversed(line.split("  ")) for line in out.getvalue().splitlines()[:-1])
+        for name in ("i", "s", "f0"):
+            self.assertIsNone(register_bank(places[name]), name)
+        self.assertEqual(register_bank(places["f99"]), 1)
+        loop = asm[asm.index("while0:"):asm.index("GOTO while0")]
+        self.assertNotIn("BANKSEL", " ".join(loop))
+        self.assertEqual(sum(line.startswith("BANKSEL") for line in asm), 1)
+
+def run_straight_line(lines, ram):
+    """W after lines, which use only the registers in ram (address -> byte)
+    and STATUS,C, running from carry set."""
+    w, carry = 0, 1
+    code = [AsmLine.parse(line) for line in lines]
+    i = 0
+    while i < len(code):
+        op, args = code[i].op, code[i].args
+        f = int(args[0], 0) if args and args[0] != "STATUS" else None
+        if op == "MOVLW": w = int(args[0], 0)
+        elif op == "ANDLW": w &= int(args[0], 0)
+        elif op == "ADDLW": carry, w = (w + int(args[0], 0)) >> 8, (w + int(args[0], 0)) & 0xFF
+        elif op == "SUBLW":
+            carry, w = int(w <= int(args[0], 0)), (int(args[0], 0) - w) & 0xFF
+        elif op == "MOVWF": ram[f] = w
+        elif op == "CLRF": ram[f] = 0
+        elif op in ("BCF", "BSF"): carry = int(op == "BSF")
+        elif op in ("BTFSC", "BTFSS"):
+            bit = carry if f is None else ram[f] >> int(args[1]) & 1
+            i += bit == (op == "BTFSS")
+        else:
+            a = ram[f]
+            if op == "MOVF": result = a
+            elif op == "ADDWF": carry, result = (a + w) >> 8, (a + w) & 0xFF
+            elif op == "SUBWF": carry, result = int(w <= a), (a - w) & 0xFF
+            elif op == "SWAPF": result = (a << 4 | a >> 4) & 0xFF
+            elif op == "RRF": carry, result = a & 1, carry << 7 | a >> 1
+            elif op == "RLF": carry, result = a >> 7, (a << 1 | carry) & 0xFF
+            else: raise ValueError(f"unexpected {op}")
+            if args[1] == "F": ram[f] = result
+            else: w = result
+        i += 1
+    return w
+
+class TestStrengthReduction(unittest.TestCase):
+    """Test multiplication and division by constants as shift/add code"""
+
+    def run_sequence(self, lines, x):
+        """W after lines, with x in register 0x20 and scratch at 0x7F."""
+        ram = {0x20: x, 0x7F: 0x5A}
+        w = run_straight_line([line.format(x="0x20", t="0x7F") for line in lines], ram)
+        self.assertEqual(ram[0x20], x)
+        return w
+
+    def test_every_constant(self):
+        """Test x * k and x / k come out right for every byte"""
+        for k in range(256):
+            mul, div = constant_sequence("*", k), constant_sequence("/", k)
+            for x in range(0, 256, 11):
+                self.assertEqual(self.run_sequence(mul, x), x * k & 0xFF, (k, x))
+                if k:
+                    self.assertEqual(self.run_sequence(div, x), x // k, (k, x))
+        self.assertIsNone(constant_sequence("/", 0))
+
+    def test_nibble_swap(self):
+        """Test scaling by 16 both ways is a swap and a mask"""
+        self.assertEqual(constant_sequence("*", 16), ["SWAPF {x}, W", "ANDLW 0xF0"])
+        self.assertEqual(constant_sequence("/", 16), ["SWAPF {x}, W", "ANDLW 0x0F"])
+        self.assertEqual(constant_sequence("/", 2), ["RRF {x}, W", "ANDLW 0x7F"])
+
+    def test_cost_model(self):
+        """Test signed digits win where they are cheaper, and every sequence beats a loop"""
+        # 15 = 16 - 1: a swap and a subtraction instead of four adds
+        self.assertEqual(constant_sequence("*", 15),
+                         ["SWAPF {x}, W", "ANDLW 0xF0", "SUBWF {x}, W", "SUBLW 0x00"])
+        self.assertEqual(constant_sequence("*", 255), ["MOVF {x}, W", "SUBLW 0x00"])
+        self.assertEqual(sequence_cost(constant_sequence("/", 200)), (5, 5))
+        for k in range(1, 256):
+            self.assertLess(sequence_cost(constant_sequence("*", k))[0], software_multiply_cycles)
+            self.assertLess(sequence_cost(constant_sequence("/", k))[0], software_divide_cycles)
+
+    def test_selected_in_place(self):
+        """Test the compiler reads a variable where it is instead of copying it"""
+        asm = compile_source("char a; char c; c = a * 3; c = 4 * c; c = c / 8;")
+        self.assertNotIn("not implemented", asm)
+        self.assertEqual(asm.splitlines()[:4],
+                         ["MOVF 0x20, W", "ADDWF 0x20, W", "ADDWF 0x20, W", "MOVWF 0x21"])
+        self.assertIn("CALL __div8", compile_source("char a; a = 8 / a;"))
+
+class TestRuntimeLibrary(unittest.TestCase):
+    """Test the shared multiply and divide helpers and the -Os/-O2 modes"""
+
+    def test_helpers_linked_once(self):
+        """Test each helper used follows the program once, and only those used"""
+        asm = compile_source("char a; char b; a = a * b; b = b * a; a = a / b;").splitlines()
+        self.assertEqual(asm.count("CALL __mul8"), 2)
+        self.assertEqual([line for line in asm if line.startswith("__") and ":" in line],
+                         ["__end:", "__mul8:", "__mul8_loop:", "__div8:", "__div8_loop:"])
+        self.assertLess(asm.index("GOTO __end"), asm.index("__mul8:"))
+        self.assertNotIn("__", compile_source("char a; a = a * 3;"))
+
+    def test_speed_unrolls_in_loops(self):
+        """Test -O2 unrolls a loop's multiply in place while -Os calls"""
+        code = "char a; char b; while (a) { b = b * a; a = a - 1; } b = b / a;"
+        size = compile_source(code)
+        speed = compile_source(code, speed=True).splitlines()
+        self.assertIn("CALL __mul8", size)
+        self.assertNotIn("CALL __mul8", speed)
+        self.assertEqual(sum(line.startswith("BTFSC 0x20,") for line in speed), 8)
+        self.assertIn("CALL __div8", speed)
+
+    def test_speed_calls_for_ints(self):
+        """Test -O2 still calls the 16-bit helpers for ints in a loop"""
+        code = ("int a; int b; int c; while (a) { b = b * c; c = c / b; a = a - 1; } "
+                "if (b + c) { }")
+        speed = compile_source(code, speed=True).splitlines()
+        self.assertIn("CALL __mul16", speed)
+        self.assertIn("CALL __sdiv16", speed)
+        self.assertEqual(speed, compile_source(code).splitlines())
+
+    def test_unrolled_arithmetic(self):
+        """Test the unrolled multiply and divide against Python"""
+        for x, y in ((0, 0), (255, 255), (200, 3), (17, 15), (129, 200), (255, 1), (96, 128)):
+            ram = {0x20: x, 0x21: y, 0x70: 0, 0x71: 0, 0x72: 0}
+            self.assertEqual(run_straight_line(unrolled_multiply("0x20", "0x21", "0x70"), ram),
+                             x * y & 0xFF, (x, y))
+            if y:
+                lines = ["MOVF 0x20, W"] + unrolled_divide("0x21", "0x70", "0x71", "0x72")
+                self.assertEqual(run_straight_line(lines, ram), x // y, (x, y))
+                self.assertEqual(ram[0x71], x % y)
+
+    def test_registers_in_memory_map(self):
+        """Test helper registers are named in the memory map"""
+        out = StringIO()
+        compile_source("char a; char b; a = a / b;", memory_map=out)
+        self.assertIn("0x7F  __div8.n", out.getvalue().splitlines())
+
+    def test_call_keeps_bank(self):
+        """Test a CALL keeps the bank when its routine touches nothing banked"""
+        code = ["MOVWF 0xA0", "CALL f", "MOVWF 0xA1", "end:", "GOTO end",
+                "f:", "MOVF {}, W", "RETURN"]
+        self.assertEqual(BankSelector().run([line.format("0x70") for line in code]).count(
+            "BANKSEL 0xA0"), 1)
+        banked = BankSelector().run([line.format("0x20") for line in code])
+        self.assertIn("BANKSEL 0xA1", banked)
+        self.assertIn("BANKSEL 0x20", banked)
+
+class TestArrays(unittest.TestCase):
+    """Test contiguous array placement and FSR/INDF indexing"""
+
+    def test_constant_index_is_direct(self):
+        """Test a constant index folds to the element's own address"""
+        self.assertEqual(compile_source("char a[4]; char b; b = a[2]; a[3] = b;").splitlines(),
+                         ["MOVF 0x22, W", "MOVWF 0x24", "MOVWF 0x23"])
+
+    def test_variable_index_uses_fsr(self):
+        """Test a variable index points FSR at the element and goes through INDF"""
+        asm = compile_source("char a[4]; char i; char b; b = a[i]; a[i] = b;").splitlines()
+        self.assertEqual(asm[:5], ["MOVF 0x24, W", "ADDLW 0x20", "MOVWF FSR", "MOVF INDF, W",
+                                   "MOVWF 0x25"])
+        self.assertEqual(asm[5:], ["MOVF 0x24, W", "ADDLW 0x20", "MOVWF FSR", "MOVF 0x25, W",
+                                   "MOVWF INDF"])
+
+    def test_offset_folds_into_base(self):
+        """Test a constant offset on the index is added to the base address"""
+        asm = compile_source("char m[4]; char i; char b; b = m[i + 1]; if (b) { }").splitlines()
+        self.assertEqual(asm[:4], ["MOVF 0x24, W", "ADDLW 0x21", "MOVWF FSR", "MOVF INDF, W"])
+
+    def test_contiguous_in_memory_map(self):
+        """Test an array takes consecutive bytes, sized by declaration or by use"""
+        out = StringIO()
+        compile_source("char a[4]; char b; b = a[1]; if (b) { }", memory_map=out)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ["0x20  a[4]", "0x24  b", "5 of 368 bytes used, 0 saved by overlaying"])
+        out = StringIO()
+        compile_source("char b; b = q[5]; if (b) { }", memory_map=out)
+        self.assertIn("0x21  q[6]", out.getvalue().splitlines())
+
+    def test_upper_banks_set_irp(self):
+        """Test an array in bank 2 or 3 is reached with IRP set around the access"""
+        code = ("char p[80]; char q[80]; char r[80]; char i; p[i] = 1; q[i] = 2; r[i] = 3; "
+                "if (p[0] + q[0] + r[0]) { }")
+        asm = compile_source(code).splitlines()
+        self.assertEqual(asm.count("BSF STATUS, IRP"), 1)
+        start = asm.index("BSF STATUS, IRP")
+        self.assertEqual(asm[start - 2:start + 4], ["ADDLW 0x10", "MOVWF FSR", "BSF STATUS, IRP",
+                                                    "MOVLW 0x03", "MOVWF INDF", "BCF STATUS, IRP"])
+
+class TestLoops(unittest.TestCase):
+    """Test loop rotation, DECFSZ/INCFSZ counting loops and the cycle listing"""
+
+    def test_rotated_to_bottom_test(self):
+        """Test a loop is entered at its test, which sits below the body"""
+        self.assertEqual(compile_source("char a; char b; while (a != b) { a = a + 2; } if (a) { }"),
+                         "GOTO wtest2\n; while0: 8 cycles per iteration\nwhile0:\n"
+                         "MOVF 0x20, W\nADDLW 0x02\nMOVWF 0x20\nwtest2:\n"
+                         "MOVF 0x20, W\nXORWF 0x21, W\nBTFSS STATUS, Z\nGOTO while0\nMOVF 0x20, F")
+        # A test the code before it decides needs no entry jump
+        asm = compile_source("char a; a = 0; while (a != 10) { a = a + 2; } if (a) { }")
+        self.assertNotIn("GOTO wtest", asm)
+
+    def test_count_down_with_decfsz(self):
+        """Test a loop running its counter down to zero ends in DECFSZ"""
+        code = "char i; char s; i = 5; while (i > 0) { s = s + i; i = i - 1; } if (s) { }"
+        self.assertEqual(compile_source(code).splitlines(),
+                         ["MOVLW 0x05", "MOVWF 0x20", "; while0: 6 cycles per iteration",
+                          "while0:", "MOVF 0x21, W", "ADDWF 0x20, W", "MOVWF 0x21",
+                          "DECFSZ 0x20, F", "GOTO while0", "MOVF 0x21, F"])
+        # Without a known start, zero is tested once on the way in
+        asm = compile_source("char i; char s; while (i) { s = s + 2; i = i - 1; } if (s) { }")
+        self.assertEqual(asm.splitlines()[:3], ["MOVF 0x20, F", "BTFSC STATUS, Z", "GOTO wend1"])
+        self.assertIn("DECFSZ 0x20, F\nGOTO while0", asm)
+
+    def test_count_up_with_incfsz(self):
+        """Test an unread counter running up to a limit counts from -trips with INCFSZ"""
+        code = "char i; char s; i = 0; while (i < 8) { s = s + 3; i = i + 1; } if (s + i) { }"
+        asm = compile_source(code).splitlines()
+        self.assertEqual(asm[:2], ["MOVLW 0xF8", "MOVWF 0x20"])
+        self.assertEqual(asm[asm.index("INCFSZ 0x20, F"):][:4],
+                         ["INCFSZ 0x20, F", "GOTO while0", "MOVLW 0x08", "MOVWF 0x20"])
+        # The body reads it, so it keeps its values
+        asm = compile_source("char i; char s; i = 0; while (i < 8) { s = s + i; i = i + 1; } "
+                             "if (s) { }")
+        self.assertNotIn("INCFSZ", asm)
+
+    def test_cycles_per_iteration(self):
+        """Test the listing's cycle counts over paths, inner loops and calls"""
+        code = ["top:", "BTFSC 0x20, 0", "CALL f", "inner:", "DECFSZ 0x21, F", "GOTO inner",
+                "GOTO top", "end:", "GOTO end"]
+        self.assertEqual(annotate_loops(code),
+                         ["; top: 6-7 cycles per iteration (inner loops once, f not counted)",
+                          "top:", "BTFSC 0x20, 0", "CALL f", "; inner: 3 cycles per iteration",
+                          "inner:", "DECFSZ 0x21, F", "GOTO inner", "GOTO top", "end:",
+                          "GOTO end"])
+
+class TestLoopOptimizer(unittest.TestCase):
+    """Test loop-invariant code motion and induction-variable strength reduction"""
+
+    def optimize(self, code):
+        program = IterativeParser(MiniCLexer(code).tokenize()).parse()
+        return str(LoopOptimizer().run(lower_to_ir(program).link())).split("while0:\n")
+
+    def test_invariant_hoisted_to_preheader(self):
+        """Test an expression of unwritten variables runs once before the loop"""
+        preheader, loop = self.optimize(
+            "int a; int b; int s; int i; i = 3; while (i) { s = s + (a * 3 + b); i = i - 1; }")
+        self.assertTrue(preheader.endswith("  i = 3\n  %1 = a * 3\n  %2 = %1 + b\n"
+                                           "  while0.inv1 = %2\n"))
+        self.assertEqual(loop, "  s = s + while0.inv1\n  i = i - 1\n  if bool i goto while0\n"
+                               "wend1:")
+
+    def test_written_operand_stays(self):
+        """Test an expression of a variable the loop writes is not hoisted"""
+        preheader, loop = self.optimize(
+            "int a; int s; int i; i = 3; while (i) { s = s + a * 7; a = s; i = i - 1; }")
+        self.assertNotIn("a * 7", preheader)
+        self.assertIn("%1 = a * 7", loop)
+
+    def test_induction_product_becomes_running_sum(self):
+        """Test base + i * 4 is set up before the loop and stepped with i"""
+        preheader, loop = self.optimize(
+            "int m[32]; int b; int s; int i; i = 0; while (i < 6) { s = s + m[b + i * 4]; "
+            "i = i + 1; }")
+        self.assertTrue(preheader.endswith("  %6 = i * 4\n  while0.iv1 = b + %6\n"))
+        self.assertEqual(loop.splitlines()[:4], ["  %3 = m[while0.iv1]", "  s = s + %3",
+                                                 "  while0.iv1 = while0.iv1 + 4",
+                                                 "  i = i + 1"])
+        # Subtracted products step down; a doubling costs less than a step
+        _, loop = self.optimize("int s; int i; i = 0; while (i < 4) { s = s + (10 - i * 3); "
+                                "i = i + 2; }")
+        self.assertIn("while0.iv1 = while0.iv1 + 250", loop)
+        _, loop = self.optimize("int s; int i; i = 0; while (i < 6) { s = s + i * 2; i = i + 1; }")
+        self.assertIn("%1 = i * 2", loop)
+
+    def test_driver_saves_cycles(self):
+        """Test the driver runs the pass, reports it and the listing shows the saving"""
+        code = ("char m[32]; char b; char i; char s; char k; i = 0; "
+                "while (i < 6) { s = s + m[b + i * 4] + k * 3; i = i + 1; } if (s) { }")
+        out, ram = StringIO(), StringIO()
+        fast = compile_source(code, report=out, memory_map=ram).splitlines()
+        slow = compile_source(code, licm=False).splitlines()
+        self.assertIn("; while0: 17 cycles per iteration", fast)
+        self.assertIn("; while0: 22 cycles per iteration", slow)
+        self.assertIn("licm induction variables: 1", out.getvalue().splitlines())
+        self.assertIn("0x44  while0.inv1", ram.getvalue().splitlines())
+
+class TestTypes(unittest.TestCase):
+    """Test type checking and 16-bit code for ints"""
+
+    def check(self, code):
+        program = IterativeParser(MiniCLexer(code).tokenize()).parse()
+        return str(TypeChecker().run(lower_to_ir(program)).link())
+
+    def test_int_add_carries_into_high_byte(self):
+        """Test ints add low bytes, then the carry and high bytes; chars one byte"""
+        self.assertEqual(compile_source("int a; int b; a = a + b; if (a) { }").splitlines(),
+                         ["MOVF 0x22, W", "ADDWF 0x20, F", "MOVF 0x23, W", "BTFSC STATUS, C",
+                          "ADDLW 0x01", "ADDWF 0x21, F", "MOVF 0x20, W", "IORWF 0x21, W"])
+        self.assertEqual(compile_source("char a; char b; a = a + b; if (a) { }").splitlines(),
+                         ["MOVF 0x20, W", "ADDWF 0x21, W", "MOVWF 0x20", "MOVF 0x20, F"])
+
+    def test_byte_results_narrowed(self):
+        """Test int arithmetic only stored to a byte is done on bytes"""
+        out = StringIO()
+        asm = compile_source("int i; char c; c = i + 1; if (c) { }", report=out)
+        self.assertEqual(asm.splitlines()[:3], ["MOVF 0x20, W", "ADDLW 0x01", "MOVWF 0x22"])
+        self.assertIn("types narrowed to 8 bits: 1", out.getvalue().splitlines())
+
+    def test_comparisons_and_bools(self):
+        """Test bools store truth values and int comparisons are signed"""
+        self.assertEqual(self.check("int i; bool f; f = i; if (f < i) { i = 300; }"),
+                         "; block 0\n  decl i\n  decl f\n  f = bool i (16-bit)\n"
+                         "  ifnot f < i (16-bit) goto else0\n; block 1\n  i = 300 (16-bit)\n"
+                         "  goto ifend1\nelse0:\nifend1:")
+        # Below zero is the sign bit for an int, and never for a char
+        asm = compile_source("int a; char b; if (a < 0) { b = 1; } if (b) { }")
+        self.assertEqual(asm.splitlines()[:4], ["MOVLW 0x80", "ANDWF 0x21, W",
+                                                "BTFSC STATUS, Z", "GOTO else0"])
+        self.assertEqual(compile_source("char a; if (a < 0) { a = 1; } if (a) { }"),
+                         "MOVF 0x20, F")
+
+    def test_int_arrays(self):
+        """Test an int array element takes two bytes, low first"""
+        ram = StringIO()
+        asm = compile_source("int m[3]; char i; m[i] = 300; if (m[0]) { }", memory_map=ram)
+        self.assertEqual(ram.getvalue().splitlines()[:2], ["0x20  m[3]", "0x26  i"])
+        self.assertEqual(asm.splitlines()[:10],
+                         ["MOVF 0x26, W", "MOVWF FSR", "ADDWF FSR, W", "ADDLW 0x20",
+                          "MOVWF FSR", "MOVLW 0x2C", "MOVWF INDF", "INCF FSR, F",
+                          "MOVLW 0x01", "MOVWF INDF"])
+
+    def test_int_runtime_helpers(self):
+        """Test int multiply and signed divide call their 16-bit helpers"""
+        out = StringIO()
+        asm = compile_source("int a; int b; a = a * b; b = a / b; if (a + b) { }", report=out)
+        self.assertIn("CALL __mul16", asm)
+        self.assertIn("CALL __sdiv16", asm)
+        self.assertIn("runtime __mul16, __div16 linked", out.getvalue().splitlines())
+        # By a power of two is a shift
+        self.assertNotIn("CALL", compile_source("int a; a = a * 4; if (a) { }"))
+
+    def test_banked_signed_byte_extended(self):
+        """Test a signed byte in bank 1 is sign-extended into common RAM, with
+        no BANKSEL between the bit test and what it guards"""
+        fill = [f"f{i}" for i in range(100)]
+        code = ("".join(f"char {n}; " for n in fill) + "int a; int t; "
+                + "".join(f"{n} = 1; " for n in fill) + "t = 65531; a = t + a; "
+                + f"if ({' + '.join(fill + ['a'])}) {{ }}")
+        asm = compile_source(code).splitlines()
+        start = asm.index("MOVLW 0xFB")
+        self.assertEqual(asm[start:start + 6], ["MOVLW 0xFB", "MOVWF 0xA9", "CLRF 0x7F",
+                                                "BTFSC 0xA9, 7", "DECF 0x7F, F",
+                                                "MOVF 0xA9, W"])
+        self.assertEqual(register_bank("0xA9"), 1)
+        self.assertIsNone(register_bank("0x7F"))
+
+    def test_folding_agrees_with_code(self):
+        """Test a constant expression folds to what the code computes with a
+        byte variable holding the same value in its place"""
+        for expr in ("c * 2 / 2", "(c - 1) < 1", "(c - 201) / 2", "-c", "c + 100 > 255"):
+            values = []
+            for rhs in (expr, expr.replace("c", "200")):
+                ram = {}
+                run_straight_line(compile_source(f"char c; int x; c = 200; x = {rhs};",
+                                                 dce=False, narrow=False).splitlines(), ram)
+                values.append(ram[0x21] | ram[0x22] << 8)
+            self.assertEqual(values[0], values[1], expr)
+
+    def test_float_rejected(self):
+        """Test a float declaration is a clear error"""
+        with self.assertRaises(TypeCheckException) as ctx:
+            compile_source("float x; x = 1;")
+        self.assertEqual(str(ctx.exception),
+                         "x is declared float, which PIC16 code has no instructions for")
+
+class TestRanges(unittest.TestCase):
+    """Test ints whose range fits a byte are narrowed to 8 bits"""
+
+    counter = "int i; char m[10]; i = 0; while (i < 10) { m[i] = i; i = i + 1; } if (m[3]) { }"
+
+    def test_counter_narrowed_to_char(self):
+        """Test a loop counter bounded by its test takes one byte and byte code"""
+        out, ram = StringIO(), StringIO()
+        asm = compile_source(self.counter, report=out, memory_map=ram)
+        self.assertIn("ranges narrowed i: 0..10", out.getvalue().splitlines())
+        self.assertEqual(ram.getvalue().splitlines()[:2], ["0x20  i", "0x21  m[10]"])
+        self.assertEqual(asm.splitlines()[9:15], ["MOVF 0x20, W", "ADDLW 0x01", "MOVWF 0x20",
+                                                  "SUBLW 0x09", "BTFSC STATUS, C",
+                                                  "GOTO while0"])
+
+    def test_signed_range_narrowed_to_schar(self):
+        """Test a range below zero is a signed byte, compared offset by 0x80
+        and sign-extended when 16-bit code reads it"""
+        out = StringIO()
+        asm = compile_source("int t; int s; t = 65531; while (t < 5) { t = t + 1; } "
+                             "s = t + 1000; if (s) { }", report=out).splitlines()
+        self.assertIn("ranges narrowed t: -5..5", out.getvalue().splitlines())
+        self.assertEqual(asm[4:11], ["MOVF 0x20, W", "ADDLW 0x01", "MOVWF 0x20", "ADDLW 0x80",
+                                     "SUBLW 0x84", "BTFSC STATUS, C", "GOTO while0"])
+        self.assertEqual(asm[11:14], ["CLRF 0x7F", "BTFSC 0x20, 7", "DECF 0x7F, F"])
+
+    def test_branches_bound_values(self):
+        """Test a value bounded by the tests guarding it is computed on bytes"""
+        asm = compile_source("int i; int j; if (i > 0) { if (i < 100) { j = i + 1; } } "
+                             "if (j) { }")
+        self.assertIn("ADDLW 0x01\nMOVWF 0x22\nCLRF 0x23", asm)
+
+    def test_wide_range_kept(self):
+        """Test an int that can reach 300, or holds what it started with, stays 16-bit"""
+        for source in ("int i; i = 0; while (i < 300) { i = i + 1; } if (i) { }",
+                       "int i; i = i + 1; if (i) { }"):
+            out = StringIO()
+            asm = compile_source(source, report=out)
+            self.assertNotIn("ranges narrowed", out.getvalue())
+            self.assertEqual(asm, compile_source(source, narrow=False))
+
+    def test_loaded_element_kept(self):
+        """Test a variable last set from an array element keeps its type's
+        range, with dce off leaving the load to write it directly"""
+        for value in (300, 65535):
+            source = f"int v; int a[2]; a[1] = {value}; v = 40; v = a[1];"
+            out = StringIO()
+            asm = compile_source(source, dce=False, report=out)
+            self.assertNotIn("ranges narrowed v", out.getvalue())
+            self.assertTrue(asm.endswith("MOVF 0x24, W\nMOVWF 0x20\nMOVF 0x25, W\nMOVWF 0x21"),
+                            value)
+
+    def test_report_and_switch(self):
+        """Test the report gives the RAM and cycles saved, and narrow=False
+        keeps 16-bit code"""
+        out = StringIO()
+        compile_source(self.counter, report=out)
+        self.assertIn("ranges saved: 2 bytes, 8 cycles", out.getvalue().splitlines())
+        out = StringIO()
+        asm = compile_source(self.counter, report=out, narrow=False)
+        self.assertNotIn("pass ranges", out.getvalue())
+        self.assertIn("INCF 0x21, F", asm)
 
 # Additional test to make sure our parser handles both program styles
 class TestParserProgramStyles(unittest.TestCase):
@@ -4,6 +4,11 @@ import sys
 
 # Import the test module - adjust the import as needed based on your actual file name
 from paste import TestMiniCLexer, TestParser, TestCodeGenVisitor, TestParserProgramStyles
+from paste import TestCompilerDriver, TestASTArena, TestASTWalker, TestIncrementalParser
+from paste import TestConstantFolder, TestPeepholeOptimizer, TestIRPipeline
+from paste import TestDeadCodeEliminator, TestRamAllocator, TestBankSelection
+from paste import TestStrengthReduction, TestRuntimeLibrary, TestArrays, TestLoops
+from paste import TestLoopOptimizer, TestTypes, TestRanges
 
 # Create a test suite with all the test classes
 def create_test_suite():
@@ -14,6 +19,23 @@ def create_test_suite():
     suite.addTest(unittest.makeSuite(TestParser))
     suite.addTest(unittest.makeSuite(TestCodeGenVisitor))
     suite.addTest(unittest.makeSuite(TestParserProgramStyles))
+    suite.addTest(unittest.makeSuite(TestCompilerDriver))
+    suite.addTest(unittest.makeSuite(TestASTArena))
+    suite.addTest(unittest.makeSuite(TestASTWalker))
+    suite.addTest(unittest.makeSuite(TestIncrementalParser))
+    suite.addTest(unittest.makeSuite(TestConstantFolder))
+    suite.addTest(unittest.makeSuite(TestPeepholeOptimizer))
+    suite.addTest(unittest.makeSuite(TestIRPipeline))
+    suite.addTest(unittest.makeSuite(TestDeadCodeEliminator))
+    suite.addTest(unittest.makeSuite(TestRamAllocator))
+    suite.addTest(unittest.makeSuite(TestBankSelection))
+    suite.addTest(unittest.makeSuite(TestStrengthReduction))
+    suite.addTest(unittest.makeSuite(TestRuntimeLibrary))
+    suite.addTest(unittest.makeSuite(TestArrays))
+    suite.addTest(unittest.makeSuite(TestLoops))
+    suite.addTest(unittest.makeSuite(TestLoopOptimizer))
+    suite.addTest(unittest.makeSuite(TestTypes))
+    suite.addTest(unittest.makeSuite(TestRanges))
     
     return suite
 